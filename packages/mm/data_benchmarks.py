@@ -0,0 +1,275 @@
+import argparse
+import csv
+import datetime
+import json
+import pathlib
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+import typing
+
+import numpy
+
+import mm.data_utilities
+
+#------------------------------------------------------------------------------    
+# Benchmarks for the mm.data_utilities pipeline. Each case writes a
+# deterministic synthetic csv file and times the stages of process_data:
+# read, header check, normalize, parse and write. The read_mmap stage times
+# process_csv_mmap reading only the canonical columns, for comparison with
+# read. Results are saved as JSON so runs can be compared with
+# compare_benchmark_results.
+#------------------------------------------------------------------------------    
+class benchmark_case(typing.NamedTuple):
+    name            : str
+    n_rows          : int
+    column_kinds    : list
+    dirty_fraction  : float = 0.0
+    n_missing       : int = 0
+    n_keep          : int = 0
+
+class stage_result(typing.NamedTuple):
+    seconds      : float
+    peak_bytes   : int
+
+column_kind_list = ['int', 'float', 'percentage', 'date', 'decimal', 'bool', 'text']
+
+# Values that do not parse, mixed into non-boolean columns of dirty cases.
+dirty_value_list = ['', 'n/a', 'NULL', '-', '#VALUE!', '?']
+
+#------------------------------------------------------------------------------    
+def default_benchmark_cases(scale=1.0):
+    n_rows = lambda x: max(1, int(x * scale))
+
+    return [
+        benchmark_case('narrow',          n_rows(200000), ['int', 'float', 'date', 'bool', 'text']),
+        benchmark_case('wide',            n_rows(5000),   column_kind_list * 30),
+        benchmark_case('date_heavy',      n_rows(100000), ['date'] * 8 + ['int']),
+        benchmark_case('decimal_heavy',   n_rows(100000), ['decimal'] * 6 + ['percentage'] * 2 + ['int']),
+        benchmark_case('dirty',           n_rows(100000), ['int', 'float', 'percentage', 'date', 'decimal', 'text'], dirty_fraction=0.05),
+        benchmark_case('missing_headers', n_rows(100000), column_kind_list * 2, n_missing=4),
+        benchmark_case('wide_subset',     n_rows(200000), ['int'] * 40, n_keep=3),
+    ]
+
+#------------------------------------------------------------------------------    
+def synthetic_value(column_kind, rng):
+    if column_kind == 'int':
+        return str(rng.randint(-10**6, 10**6))
+    elif column_kind == 'float':
+        return repr(rng.uniform(-1000.0, 1000.0))
+    elif column_kind == 'percentage':
+        return '{:.2f}%'.format(rng.uniform(0.0, 100.0))
+    elif column_kind == 'date':
+        return (datetime.date(1990, 1, 1) + datetime.timedelta(days=rng.randrange(12000))).isoformat()
+    elif column_kind == 'decimal':
+        return '{}.{:02d}'.format(rng.randint(0, 10**7), rng.randrange(100))
+    elif column_kind == 'bool':
+        return rng.choice(('True', 'False', ''))
+    else:
+        return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for k in range(rng.randint(3, 20)))
+
+#------------------------------------------------------------------------------    
+def generate_benchmark_file(output_file_path, case, seed=0):
+    # Returns the canonical headers and the parse_plan for the generated file.
+    rng = random.Random(seed)
+
+    headers = [kind + '_' + str(k) for k, kind in enumerate(case.column_kinds)]
+
+    # Canonical headers the file does not have, and file headers the canonical list drops.
+    canonical_headers = headers[case.n_missing:] + ['absent_' + str(k) for k in range(case.n_missing)]
+    canonical_kinds = case.column_kinds[case.n_missing:]
+
+    # Or only 'n_keep' columns spread across the file, first and last included
+    if case.n_keep:
+        n_columns = len(headers)
+        keep_indices = sorted({round(k * (n_columns - 1) / max(case.n_keep - 1, 1)) for k in range(case.n_keep)})
+        canonical_headers = [headers[k] for k in keep_indices]
+        canonical_kinds = [case.column_kinds[k] for k in keep_indices]
+
+    with output_file_path.open('w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(headers)
+
+        for k in range(case.n_rows):
+            row = [synthetic_value(x, rng) for x in case.column_kinds]
+
+            if case.dirty_fraction:
+                for idx, kind in enumerate(case.column_kinds):
+                    if kind != 'bool' and rng.random() < case.dirty_fraction:
+                        row[idx] = rng.choice(dirty_value_list)
+
+            writer.writerow(row)
+
+    idx_kind = lambda kind: [k for k, x in enumerate(canonical_kinds) if x == kind]
+
+    plan = mm.data_utilities.parse_plan(idx_int=idx_kind('int'), idx_float=idx_kind('float'),
+                                        idx_percentage=idx_kind('percentage'), idx_date=idx_kind('date'),
+                                        idx_decimal=idx_kind('decimal'), idx_boolean=idx_kind('bool'))
+
+    return (canonical_headers, plan)
+
+#------------------------------------------------------------------------------    
+def run_pipeline_stages(input_file_path, output_file_path, canonical_headers, plan, track_memory=False):
+    stage_results = {}
+    stage_start = [0.0]
+
+    def start_stage():
+        if track_memory:
+            tracemalloc.reset_peak()
+        stage_start[0] = time.perf_counter()
+
+    def end_stage(stage_name):
+        seconds = time.perf_counter() - stage_start[0]
+        peak_bytes = tracemalloc.get_traced_memory()[1] if track_memory else 0
+        stage_results[stage_name] = stage_result(seconds, peak_bytes)
+
+    start_stage()
+    with input_file_path.open('r', newline='', encoding='utf-8') as csv_file:
+        (headers, column_values) = mm.data_utilities.process_csv_data(csv.reader(csv_file))
+    end_stage('read')
+
+    start_stage()
+    mm.data_utilities.process_csv_mmap(input_file_path, keep_headers=canonical_headers)
+    end_stage('read_mmap')
+
+    start_stage()
+    mm.data_utilities.clear_column_mapping_cache()
+    mapping = mm.data_utilities.compile_column_mapping(canonical_headers, headers)
+    end_stage('header_check')
+
+    start_stage()
+    column_values = mapping.apply(column_values)
+    end_stage('normalize')
+
+    start_stage()
+    column_values = plan(column_values)
+    end_stage('parse')
+
+    start_stage()
+    if output_file_path.exists():
+        output_file_path.unlink()
+    mm.data_utilities.write_csv_chunks(output_file_path, [column_values], canonical_headers)
+    end_stage('write')
+
+    return stage_results
+
+#------------------------------------------------------------------------------    
+def run_benchmark(case, work_directory, seed=0, n_repeat=3, track_memory=True):
+    # Best-of-n timings; peak memory comes from one extra traced run since
+    # tracemalloc slows everything down.
+    input_file_path = work_directory.joinpath(case.name + '.csv')
+    output_file_path = work_directory.joinpath(case.name + '_out.csv')
+
+    (canonical_headers, plan) = generate_benchmark_file(input_file_path, case, seed)
+
+    best_seconds = {}
+    for k in range(n_repeat):
+        stage_results = run_pipeline_stages(input_file_path, output_file_path, canonical_headers, plan)
+        for stage_name, result in stage_results.items():
+            best_seconds[stage_name] = min(result.seconds, best_seconds.get(stage_name, result.seconds))
+
+    peak_bytes = {}
+    if track_memory:
+        tracemalloc.start()
+        try:
+            stage_results = run_pipeline_stages(input_file_path, output_file_path, canonical_headers, plan, track_memory=True)
+            peak_bytes = {x: y.peak_bytes for x, y in stage_results.items()}
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'case'        : case._asdict(),
+        'file_bytes'  : input_file_path.stat().st_size,
+        'seconds'     : best_seconds,
+        'total_seconds': sum(best_seconds.values()),
+        'peak_bytes'  : peak_bytes,
+    }
+
+#------------------------------------------------------------------------------    
+def run_benchmark_suite(cases=None, seed=0, n_repeat=3, track_memory=True, work_directory=None):
+    if cases is None:
+        cases = default_benchmark_cases()
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        work_directory = work_directory or pathlib.Path(temp_directory)
+        case_results = [run_benchmark(x, work_directory, seed, n_repeat, track_memory) for x in cases]
+
+    return {
+        'timestamp'     : datetime.datetime.now().isoformat(timespec='seconds'),
+        'python_version': platform.python_version(),
+        'numpy_version' : numpy.__version__,
+        'platform'      : platform.platform(),
+        'seed'          : seed,
+        'results'       : case_results,
+    }
+
+#------------------------------------------------------------------------------    
+def write_benchmark_results(suite_results, output_file_path):
+    output_file_path.write_text(json.dumps(suite_results, indent=2), encoding='utf-8')
+
+#------------------------------------------------------------------------------    
+def read_benchmark_results(input_file_path):
+    return json.loads(input_file_path.read_text(encoding='utf-8'))
+
+#------------------------------------------------------------------------------    
+def compare_benchmark_results(baseline_results, current_results):
+    # Ratio of current to baseline seconds per case and stage; below 1 is faster.
+    baseline_dict = {x['case']['name']: x for x in baseline_results['results']}
+    comparison = {}
+
+    for result in current_results['results']:
+        case_name = result['case']['name']
+        if case_name not in baseline_dict:
+            continue
+
+        baseline_seconds = baseline_dict[case_name]['seconds']
+        comparison[case_name] = {stage_name: seconds / baseline_seconds[stage_name]
+                                 for stage_name, seconds in result['seconds'].items()
+                                 if baseline_seconds.get(stage_name)}
+
+    return comparison
+
+#------------------------------------------------------------------------------    
+def benchmark_report(suite_results, comparison=None):
+    report_lines = []
+
+    for result in suite_results['results']:
+        case_name = result['case']['name']
+        report_lines.append(case_name + ' (' + str(result['case']['n_rows']) + ' rows, '
+                            + str(result['file_bytes']) + ' bytes)')
+
+        for stage_name, seconds in result['seconds'].items():
+            stage_line = '    {:<14}{:>10.4f} s'.format(stage_name, seconds)
+            if stage_name in result['peak_bytes']:
+                stage_line += '{:>12.1f} MB'.format(result['peak_bytes'][stage_name] / 2**20)
+            if comparison and stage_name in comparison.get(case_name, {}):
+                stage_line += '{:>10.2f}x'.format(comparison[case_name][stage_name])
+            report_lines.append(stage_line)
+
+    return '\n'.join(report_lines)
+
+#------------------------------------------------------------------------------ 
+# Entry Point
+#------------------------------------------------------------------------------ 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the mm.data_utilities pipeline.')
+    parser.add_argument('--output', type=pathlib.Path, help='JSON file for the results.')
+    parser.add_argument('--baseline', type=pathlib.Path, help='Earlier results JSON to compare against.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier for the number of rows.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced peak memory run.')
+    args = parser.parse_args()
+
+    suite_results = run_benchmark_suite(default_benchmark_cases(args.scale), args.seed, args.repeat, not args.no_memory)
+
+    comparison = None
+    if args.baseline:
+        comparison = compare_benchmark_results(read_benchmark_results(args.baseline), suite_results)
+
+    print(benchmark_report(suite_results, comparison))
+
+    if args.output:
+        write_benchmark_results(suite_results, args.output)
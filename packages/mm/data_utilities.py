@@ -1,10 +1,32 @@
 import decimal
 import math
+import datetime
+import re
 import dateutil.parser
 import itertools
+import functools
+import collections
+import concurrent.futures
 import ast
 import csv
+import io
+import os
+import mmap
+import array
+import json
+import time
+import hashlib
+import zlib
+import heapq
+import operator
+import tempfile
+import pathlib
+import shutil
+import typing
 import pyodbc
+import numpy
+
+import mm.misc_utilities
 
 #------------------------------------------------------------------------------    
 class ParsingError(Exception):
@@ -35,69 +57,327 @@ class ParsingError(Exception):
         return return_string
         
 #------------------------------------------------------------------------------    
-def parse_table_data(column_values, idx_int=None, idx_float=None, idx_percentage=None, idx_date=None, idx_decimal=None, idx_boolean=None, boolean_string_values=None ):
-    
-    # If no boolean strings given use the default text for printing booleans
-    if (not boolean_string_values) and (idx_boolean):
-        n_bools = len(idx_boolean)
-        boolean_string_values = [('True', 'False')] * n_bools
-    
-    n_rows = len(column_values[0])
-    
-    for idx_row in range(n_rows):
-        if idx_int:
-            for idx in idx_int:
-                try:
-                    column_values[idx][idx_row] = try_int_parse(column_values[idx][idx_row])
-                except ParsingError as parse_error:                    
-                    parse_error.idx_col = idx
-                    parse_error.idx_row = idx_row
-                    raise parse_error
-        if idx_float:
-            for idx in idx_float:
-                try:
-                    column_values[idx][idx_row] = try_float_parse(column_values[idx][idx_row])
-                except ParsingError as parse_error:                    
-                    parse_error.idx_col = idx
-                    parse_error.idx_row = idx_row
-                    raise parse_error
-        if idx_percentage:
-            for idx in idx_percentage:
-                try:
-                    column_values[idx][idx_row] = try_percentage_parse(column_values[idx][idx_row])
-                except ParsingError as parse_error:                    
-                    parse_error.idx_col = idx
-                    parse_error.idx_row = idx_row
-                    raise parse_error
-        if idx_date:
-            for idx in idx_date:
-                try:
-                    column_values[idx][idx_row] = try_date_parse(column_values[idx][idx_row])
-                except ParsingError as parse_error:                    
-                    parse_error.idx_col = idx
-                    parse_error.idx_row = idx_row
-                    raise parse_error
-        if idx_decimal:
-            for idx in idx_decimal:
-                try:
-                    column_values[idx][idx_row] = try_decimal_parse(column_values[idx][idx_row])
-                except ParsingError as parse_error:                    
-                    parse_error.idx_col = idx
-                    parse_error.idx_row = idx_row
-                    raise parse_error
+def parse_table_data(column_values, idx_int=None, idx_float=None, idx_percentage=None, idx_date=None, idx_decimal=None, idx_boolean=None, boolean_string_values=None, date_reports=None, compact=False, max_dictionary_size=0 ):
+
+    plan = parse_plan(idx_int=idx_int, idx_float=idx_float, idx_percentage=idx_percentage, idx_date=idx_date,
+                      idx_decimal=idx_decimal, idx_boolean=idx_boolean, boolean_string_values=boolean_string_values,
+                      compact=compact, max_dictionary_size=max_dictionary_size)
+
+    return plan(column_values, date_reports)
+
+#------------------------------------------------------------------------------    
+# Columnar version of parse_table_data. Converted columns are returned as
+# numpy.ma.MaskedArray objects, masked where the value is null; all other
+# columns are passed through untouched.
+#------------------------------------------------------------------------------    
+def parse_table_columns(column_values, idx_int=None, idx_float=None, idx_percentage=None, idx_date=None, idx_decimal=None, idx_boolean=None, boolean_string_values=None, date_reports=None ):
+
+    plan = parse_plan(idx_int=idx_int, idx_float=idx_float, idx_percentage=idx_percentage, idx_date=idx_date,
+                      idx_decimal=idx_decimal, idx_boolean=idx_boolean, boolean_string_values=boolean_string_values)
+
+    return plan.parse_columns(column_values, date_reports)
+
+#------------------------------------------------------------------------------    
+# Parse plans. The idx_* arguments are compiled once into an ordered list of
+# (column, data type, converter) steps, so a plan can be reused across files
+# and chunks. Plans pickle, so they can be passed to process_data_batch as
+# the data_processor. 'sentinel_values' maps a column to a value read as null.
+#------------------------------------------------------------------------------    
+def callable_signature(function):
+    # A description of 'function' that is stable between runs, e.g. to tell
+    # whether output was made by the same data_processor. parse_plan and
+    # column_pipeline describe their settings; plain functions are known by
+    # name only.
+    if hasattr(function, 'signature'):
+        return function.signature()
+    if isinstance(function, functools.partial):
+        return {'function': callable_signature(function.func),
+                'args'    : [repr(x) for x in function.args],
+                'keywords': {k: repr(x) for k, x in sorted(function.keywords.items())}}
+    return (getattr(function, '__module__', None) or '') + '.' + getattr(function, '__qualname__', type(function).__qualname__)
+
+#------------------------------------------------------------------------------    
+class parse_plan:
+    def __init__(self, idx_int=None, idx_float=None, idx_percentage=None, idx_date=None, idx_decimal=None, idx_boolean=None, boolean_string_values=None, sentinel_values=None, compact=False, max_dictionary_size=0, exact_percentage=False, decimal_scale=None):
+
+        # If no boolean strings given use the default text for printing booleans
+        if (not boolean_string_values) and (idx_boolean):
+            n_bools = len(idx_boolean)
+            boolean_string_values = [('True', 'False')] * n_bools
+
+        self.sentinel_values = dict(sentinel_values) if sentinel_values else {}
+        self.compact = compact
+        self.max_dictionary_size = max_dictionary_size
+
+        # Exact percentages are Decimals; a decimal_scale stores decimals as scaled int64.
+        percentage_converter = parse_percentage_decimal_column if exact_percentage else parse_percentage_column
+        decimal_converter = parse_decimal_column
+        if decimal_scale is not None:
+            decimal_converter = functools.partial(parse_decimal_column_fixed, scale=decimal_scale)
+
+        column_converters = [('int', idx_int, parse_int_column), ('float', idx_float, parse_float_column),
+                             ('percentage', idx_percentage, percentage_converter), ('date', idx_date, parse_date_column_report),
+                             ('decimal', idx_decimal, decimal_converter)]
+
+        self.steps = []
+        for data_type, idx_list, converter in column_converters:
+            if idx_list:
+                for idx in idx_list:
+                    self.steps.append((idx, data_type, converter))
+
         if idx_boolean:
-            for k in range(len(idx_boolean)):
-                idx = idx_boolean[k]
-                truth_values = boolean_string_values[k]
+            for idx, truth_values in zip(idx_boolean, boolean_string_values):
+                converter = functools.partial(parse_boolean_column, true_value=truth_values[0], false_value=truth_values[1])
+                self.steps.append((idx, 'bool', converter))
 
-                try:
-                    column_values[idx][idx_row] = str_to_bool(column_values[idx][idx_row], truth_values[0], truth_values[1])
-                except ParsingError as parse_error:                    
-                    parse_error.idx_col = idx
-                    parse_error.idx_row = idx_row
-                    raise parse_error
-        
-    return column_values
+    @classmethod
+    def from_schema(cls, schema, **kwargs):
+        return cls(**schema._asdict(), **kwargs)
+
+    def signature(self):
+        return {'steps'              : [[idx, data_type, callable_signature(converter)] for idx, data_type, converter in self.steps],
+                'sentinel_values'    : [[idx, repr(x)] for idx, x in sorted(self.sentinel_values.items())],
+                'compact'            : self.compact,
+                'max_dictionary_size': self.max_dictionary_size}
+
+    def null_sentinels(self, column_values):
+        n_rows = chunk_length(column_values)
+        column_values = list(column_values)
+
+        for idx, sentinel_value in self.sentinel_values.items():
+            if isinstance(column_values[idx], itertools.repeat):
+                column_values[idx] = itertools.repeat(sentinel_to_null(next(column_values[idx]), sentinel_value))
+            else:
+                column_values[idx] = [None if x == sentinel_value else x for x in column_values[idx]]
+
+        # Excluded (infinite) columns that are parsed get the block length
+        for idx, _data_type, _converter in self.steps:
+            if isinstance(column_values[idx], itertools.repeat):
+                column_values[idx] = [next(column_values[idx])] * n_rows
+
+        return column_values
+
+    def parse_columns(self, column_values, date_reports=None):
+        column_values = self.null_sentinels(column_values)
+        typed_column_values = list(column_values)
+
+        # Report the first bad boolean row over all columns, as a row-by-row pass would.
+        parse_error = None
+
+        for idx, data_type, converter in self.steps:
+            if data_type == 'date':
+                (typed_column_values[idx], report) = converter(column_values[idx])
+
+                # Optionally collect how often each date column fell back to dateutil.
+                if date_reports is not None:
+                    date_reports[idx] = report
+            elif data_type == 'bool':
+                (typed_column_values[idx], invalid_mask) = converter(column_values[idx])
+
+                invalid_rows = numpy.flatnonzero(invalid_mask)
+                if invalid_rows.size and ((parse_error is None) or (invalid_rows[0] < parse_error.idx_row)):
+                    idx_row = int(invalid_rows[0])
+                    parse_error = ParsingError()
+                    parse_error.immediate_values('bool', idx, idx_row, column_values[idx][idx_row])
+            else:
+                typed_column_values[idx] = converter(column_values[idx])
+
+        if parse_error:
+            raise parse_error
+
+        return typed_column_values
+
+    def __call__(self, column_values, date_reports=None):
+        # Same contract as parse_table_data: updates and returns 'column_values'.
+        typed_column_values = self.parse_columns(column_values, date_reports)
+
+        # Keep them as typed_column / dictionary_column containers.
+        if self.compact:
+            column_values[:] = compact_columns(typed_column_values, self.max_dictionary_size)
+            return column_values
+
+        # Or hand back plain lists with None for nulls.
+        for idx in self.sentinel_values:
+            column_values[idx] = typed_column_values[idx]
+
+        for idx, _data_type, _converter in self.steps:
+            column_values[idx] = typed_column_values[idx].tolist()
+
+        return column_values
+
+    def validate(self, column_values, max_errors=1000):
+        column_values = self.null_sentinels(column_values)
+        typed_column_values = list(column_values)
+        table_errors = []
+
+        for idx, data_type, converter in self.steps:
+            if data_type == 'date':
+                (typed_column_values[idx], _report) = converter(column_values[idx])
+            elif data_type == 'bool':
+                (typed_column_values[idx], error_mask) = converter(column_values[idx])
+            else:
+                typed_column_values[idx] = converter(column_values[idx])
+
+            if data_type != 'bool':
+                # Empty cells are nulls, not errors.
+                is_filled = numpy.array([bool(x.strip()) for x in _text_list(column_values[idx])], dtype=bool)
+                error_mask = numpy.ma.getmaskarray(typed_column_values[idx]) & is_filled
+
+            if error_mask.any():
+                table_errors.append(_collect_column_errors(idx, data_type, error_mask, column_values[idx], max_errors))
+
+        return (typed_column_values, table_errors)
+
+#------------------------------------------------------------------------------  
+# Compact column containers. Both iterate as plain Python values with None for
+# nulls, so csv.writer, zip(*column_values) and db_tools.io.insert_into_db can
+# consume them like lists.
+#------------------------------------------------------------------------------  
+class typed_column:
+    # 'values' is a NumPy array; 'validity' is a packed bitmap with a 1 bit for
+    # each non-null value, or None if the column has no nulls.
+    block_size = 1 << 16
+
+    def __init__(self, values, validity=None):
+        self.values = values
+        self.validity = validity
+
+    @classmethod
+    def from_masked(cls, masked_column):
+        values = numpy.ma.getdata(masked_column)
+        valid_mask = ~numpy.ma.getmaskarray(masked_column)
+
+        # Naive datetimes pack into datetime64; anything else stays as objects.
+        if values.dtype == object:
+            valid_values = values[valid_mask]
+            if valid_values.size and all(type(x) is datetime.datetime and x.tzinfo is None for x in valid_values):
+                filled_values = values.copy()
+                filled_values[~valid_mask] = datetime.datetime(1970, 1, 1)
+                values = filled_values.astype('datetime64[us]')
+
+        return cls.from_mask(values, valid_mask)
+
+    @classmethod
+    def from_mask(cls, values, valid_mask):
+        if valid_mask.all():
+            return cls(values)
+        return cls(values, numpy.packbits(valid_mask, bitorder='little'))
+
+    def valid_mask(self):
+        if self.validity is None:
+            return numpy.ones(len(self.values), dtype=bool)
+        return numpy.unpackbits(self.validity, count=len(self.values), bitorder='little').astype(bool)
+
+    def null_count(self):
+        return len(self.values) - int(numpy.count_nonzero(self.valid_mask()))
+
+    def nbytes(self):
+        return self.values.nbytes + (0 if self.validity is None else self.validity.nbytes)
+
+    def to_masked(self):
+        return numpy.ma.MaskedArray(self.values, mask=~self.valid_mask())
+
+    def tolist(self):
+        values = self.values.tolist()
+        if self.validity is None:
+            return values
+        return [x if is_valid else None for x, is_valid in zip(values, self.valid_mask().tolist())]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        # Converts 'block_size' values at a time instead of the whole column;
+        # blocks start on a byte of the validity bitmap.
+        n_values = len(self.values)
+        for start in range(0, n_values, self.block_size):
+            stop = min(start + self.block_size, n_values)
+            values = self.values[start:stop].tolist()
+            if self.validity is None:
+                yield from values
+                continue
+
+            valid_mask = numpy.unpackbits(self.validity[start >> 3:], count=stop - start, bitorder='little')
+            yield from (x if is_valid else None for x, is_valid in zip(values, valid_mask.tolist()))
+
+    def __getitem__(self, idx):
+        # Negative indices count from the end, as for lists
+        idx = operator.index(idx)
+        if idx < 0:
+            idx += len(self.values)
+        if not 0 <= idx < len(self.values):
+            raise IndexError('typed_column index out of range')
+
+        if self.validity is not None and not (self.validity[idx >> 3] >> (idx & 7)) & 1:
+            return None
+        return self.values[idx].item()
+
+#------------------------------------------------------------------------------  
+class dictionary_column:
+    # Low cardinality text: 'codes' index into 'dictionary', -1 marks a null.
+    block_size = 1 << 16
+
+    def __init__(self, codes, dictionary):
+        self.codes = codes
+        self.dictionary = dictionary
+
+    @classmethod
+    def from_list(cls, values, max_dictionary_size=None):
+        # Returns None if there are more than 'max_dictionary_size' distinct values.
+        code_dict = {}
+        codes = numpy.empty(len(values), dtype=numpy.int32)
+
+        for k, x in enumerate(values):
+            if x is None:
+                codes[k] = -1
+                continue
+            code = code_dict.get(x)
+            if code is None:
+                code = code_dict[x] = len(code_dict)
+                if max_dictionary_size is not None and code >= max_dictionary_size:
+                    return None
+            codes[k] = code
+
+        return cls(codes, list(code_dict))
+
+    def null_count(self):
+        return int(numpy.count_nonzero(self.codes < 0))
+
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def tolist(self):
+        # A code of -1 picks the None appended to the end of the lookup.
+        lookup = self.dictionary + [None]
+        return [lookup[x] for x in self.codes.tolist()]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        lookup = self.dictionary + [None]
+        for start in range(0, len(self.codes), self.block_size):
+            yield from (lookup[x] for x in self.codes[start:start+self.block_size].tolist())
+
+    def __getitem__(self, idx):
+        code = int(self.codes[idx])
+        return None if code < 0 else self.dictionary[code]
+
+#------------------------------------------------------------------------------  
+def compact_columns(typed_column_values, max_dictionary_size=0):
+    # Masked arrays become typed_column; text lists with at most
+    # 'max_dictionary_size' distinct values become dictionary_column.
+    compact_column_values = []
+
+    for column in typed_column_values:
+        if isinstance(column, numpy.ma.MaskedArray):
+            column = typed_column.from_masked(column)
+        elif max_dictionary_size and isinstance(column, list):
+            column = dictionary_column.from_list(column, max_dictionary_size) or column
+
+        compact_column_values.append(column)
+
+    return compact_column_values
 
 #------------------------------------------------------------------------------  
 def identify_type(input_data):
@@ -107,6 +387,116 @@ def identify_type(input_data):
         # A string, so return str
         return str
 
+#------------------------------------------------------------------------------  
+# Schema inference. Samples each column and tries the try_* parsers from the
+# cheapest to the most expensive, giving idx_* lists for parse_table_data:
+#     schema = infer_schema(headers, column_values)
+#     column_values = parse_table_data(column_values, **schema._asdict())
+#------------------------------------------------------------------------------  
+class table_schema(typing.NamedTuple):
+    idx_int               : list
+    idx_float             : list
+    idx_percentage        : list
+    idx_date              : list
+    idx_decimal           : list
+    idx_boolean           : list
+    boolean_string_values : list
+
+default_boolean_string_pairs = [('True', 'False'), ('true', 'false'), ('TRUE', 'FALSE'),
+                                ('T', 'F'), ('Yes', 'No'), ('yes', 'no'), ('Y', 'N')]
+
+# Inferred schemas keyed by header signature, see infer_schema.
+_schema_cache = {}
+
+#------------------------------------------------------------------------------  
+def sample_column_values(column, n_sample=1000):
+    # Evenly spaced sample of the non-empty values in 'column'.
+    n_rows = len(column)
+    step = max(1, n_rows // n_sample)
+
+    return [x for x in itertools.islice(column, 0, n_rows, step) if x and x.strip()]
+
+#------------------------------------------------------------------------------  
+def infer_column_type(sample_values, boolean_string_pairs=None):
+    if boolean_string_pairs is None:
+        boolean_string_pairs = default_boolean_string_pairs
+
+    # Nothing to go on, leave the column as text.
+    if not sample_values:
+        return ('str', None)
+
+    value_set = set(sample_values)
+    for truth_values in boolean_string_pairs:
+        if value_set.issubset(truth_values):
+            return ('bool', truth_values)
+
+    if all(try_int_parse(x) is not None for x in value_set):
+        return ('int', None)
+
+    if all(try_float_parse(x) is not None for x in value_set):
+        return ('float', None)
+
+    if all(try_percentage_parse(x) is not None for x in value_set):
+        return ('percentage', None)
+
+    # dateutil will read a bare month name as a date, so insist on a digit.
+    if all(any(c.isdigit() for c in x) and (try_date_parse(x) is not None) for x in value_set):
+        return ('date', None)
+
+    return ('str', None)
+
+#------------------------------------------------------------------------------  
+def infer_schema(column_headers, column_values, n_sample=1000, boolean_string_pairs=None, prefer_decimal=False, schema_cache=_schema_cache):
+    if boolean_string_pairs is None:
+        boolean_string_pairs = default_boolean_string_pairs
+
+    # Files with the same headers share a schema; pass schema_cache=None to always infer.
+    cache_key = json.dumps([list(column_headers), len(column_values), n_sample,
+                            [list(x) for x in boolean_string_pairs], prefer_decimal])
+
+    if (schema_cache is not None) and (cache_key in schema_cache):
+        return schema_cache[cache_key]
+
+    schema = table_schema([], [], [], [], [], [], [])
+
+    for idx, column in enumerate(column_values):
+        (column_type, truth_values) = infer_column_type(sample_column_values(column, n_sample), boolean_string_pairs)
+
+        if column_type == 'bool':
+            schema.idx_boolean.append(idx)
+            schema.boolean_string_values.append(truth_values)
+        elif column_type == 'int':
+            schema.idx_int.append(idx)
+        elif column_type == 'float':
+            if prefer_decimal:
+                schema.idx_decimal.append(idx)
+            else:
+                schema.idx_float.append(idx)
+        elif column_type == 'percentage':
+            schema.idx_percentage.append(idx)
+        elif column_type == 'date':
+            schema.idx_date.append(idx)
+
+    if schema_cache is not None:
+        schema_cache[cache_key] = schema
+
+    return schema
+
+#------------------------------------------------------------------------------  
+def write_schema_cache(output_file_path, schema_cache=_schema_cache):
+    cache_records = {k: v._asdict() for k, v in schema_cache.items()}
+    output_file_path.write_text(json.dumps(cache_records), encoding='utf-8')
+
+#------------------------------------------------------------------------------  
+def read_schema_cache(input_file_path, schema_cache=_schema_cache):
+    cache_records = json.loads(input_file_path.read_text(encoding='utf-8'))
+
+    for cache_key, schema_fields in cache_records.items():
+        schema_fields['boolean_string_values'] = [tuple(x) for x in schema_fields['boolean_string_values']]
+        schema_cache[cache_key] = table_schema(**schema_fields)
+
+    return schema_cache
+
 #------------------------------------------------------------------------------  
 def try_float_parse(s):
     try:
@@ -120,7 +510,7 @@ def try_percentage_parse(s):
     if s.endswith('%'):
         s = s.replace('%', '')
         s = try_float_parse(s)
-        if s:
+        if s is not None:
             return s / 100.0
         else:
             return None
@@ -142,7 +532,7 @@ def try_int_parse(s):
             return int(s)
         else:
             return None
-    except ValueError: 
+    except (ValueError, OverflowError): 
         return None
 
 #------------------------------------------------------------------------------  
@@ -176,139 +566,1946 @@ def str_to_bool(s, true_value, false_value):
         return None
 
 #------------------------------------------------------------------------------    
-def process_csv_data(csv_reader, has_headers=True):    
-    if has_headers:
-        column_headers = next(csv_reader)
-        
-        n_columns = len(column_headers)
-        column_values = [[] for k in range(n_columns)] 
-    else:
-        column_headers = []
-        first_row = next(csv_reader)
-        n_columns = len(first_row)
+# Pipelines of column transforms for use as a data_processor. Stages are only
+# recorded when added; on each call, consecutive element-wise stages are fused
+# so each column is traversed once, and consecutive derived columns are
+# computed in one pass over the rows.
+#     pipeline = (column_pipeline()
+#                 .sentinel_to_null([2, 3], '-99')
+#                 .parse(idx_int=[2], idx_float=[3])
+#                 .derive([2, 3], lambda x, y: None if None in (x, y) else x * y))
+#------------------------------------------------------------------------------    
+class _composed_function:
+    def __init__(self, functions):
+        self.functions = functions
 
-        column_values = []
-        for k in range(n_columns):
-            column_values.append([first_row[k]])        
+    def __call__(self, x):
+        for function in self.functions:
+            x = function(x)
+        return x
 
-    for row in csv_reader:        
-        for idx in range(len(row)):
-            column_values[idx].append(row[idx])
-                
-    return (column_headers, column_values)
+#------------------------------------------------------------------------------    
+class column_pipeline:
+    def __init__(self):
+        self.stages = []
+
+    def map(self, idx_list, function):
+        # Element-wise transform of the listed columns.
+        self.stages.append(('map', list(idx_list), function))
+        return self
+
+    def sentinel_to_null(self, idx_list, sentinel_value):
+        return self.map(idx_list, functools.partial(sentinel_to_null, sentinel_value=sentinel_value))
+
+    def parse(self, plan=None, **parse_arguments):
+        # A parse_plan, or the parse_table_data keyword arguments to build one.
+        self.stages.append(('parse', plan or parse_plan(**parse_arguments), None))
+        return self
+
+    def derive(self, idx_sources, function):
+        # Appends a column of function(*values of the source columns) per row.
+        self.stages.append(('derive', list(idx_sources), function))
+        return self
+
+    def signature(self):
+        return [[kind, argument if kind != 'parse' else callable_signature(argument), 
+                 callable_signature(function) if function is not None else None]
+                for kind, argument, function in self.stages]
+
+    def compile(self):
+        segments = []
+
+        for kind, argument, function in self.stages:
+            if kind == 'parse':
+                segments.append(('parse', argument))
+            elif segments and segments[-1][0] == kind:
+                segments[-1][1].append((argument, function))
+            else:
+                segments.append((kind, [(argument, function)]))
+
+        return segments
+
+    def __call__(self, column_values):
+        column_values = list(column_values)
+
+        for kind, segment in self.compile():
+            if kind == 'parse':
+                column_values = segment(column_values)
+            elif kind == 'map':
+                _apply_map_segment(column_values, segment)
+            else:
+                _apply_derive_segment(column_values, segment)
+
+        return column_values
 
 #------------------------------------------------------------------------------    
-def check_column_names(canonical_headers, other_headers):    
-    canonical_set = set(canonical_headers)
-    other_set = set(other_headers)
-    
-    header_intersection = set.intersection(canonical_set, other_set)
-    header_excluded = set.difference(canonical_set, other_set)
-    header_included = set.difference(other_set, canonical_set)
-        
-    intersection_indices = [[canonical_headers.index(x) for x in header_intersection],
-                            [other_headers.index(x) for x in header_intersection]]
-    
-    excluded_indices = [canonical_headers.index(x) for x in header_excluded]
-    included_indices = [other_headers.index(x) for x in header_included]
-                    
-    return (header_intersection, header_excluded, header_included,
-             intersection_indices, excluded_indices, included_indices)
+def _apply_map_segment(column_values, segment):
+    column_functions = {}
+    for idx_list, function in segment:
+        for idx in idx_list:
+            column_functions.setdefault(idx, []).append(function)
+
+    for idx, functions in column_functions.items():
+        fused_function = functions[0] if len(functions) == 1 else _composed_function(functions)
+        column = column_values[idx]
+
+        if isinstance(column, itertools.repeat):
+            column_values[idx] = itertools.repeat(fused_function(next(column)))
+        else:
+            column_values[idx] = [fused_function(x) for x in column]
 
 #------------------------------------------------------------------------------    
-def normalize_columns(canonical_headers, intersection_indices, excluded_indices, column_values):    
-    normalized_column_values = [None] * len(canonical_headers)
+def _apply_derive_segment(column_values, segment):
+    # A derivation that reads a column derived in the same batch starts a new batch.
+    batch = []
+    for idx_sources, function in segment:
+        if batch and any(idx >= len(column_values) for idx in idx_sources):
+            _derive_columns(column_values, batch)
+            batch = []
+        batch.append((idx_sources, function))
 
-    for idx0, idx1 in zip(intersection_indices[0], intersection_indices[1]):
-        normalized_column_values[idx0] = column_values[idx1]
+        if any(idx >= len(column_values) + len(batch) - 1 for idx in idx_sources):
+            raise IndexError('derived column reads a column that does not exist yet')
 
-    for idx0 in excluded_indices:
-        normalized_column_values[idx0] = itertools.repeat(None)
-                    
-    return normalized_column_values
+    if batch:
+        _derive_columns(column_values, batch)
 
 #------------------------------------------------------------------------------    
-def column_report(header_intersection, header_excluded, header_included, intersection_indices, excluded_indices, included_indices):
-    header_intersection_report = 'Header Intersection: \n'
-    header_excluded_report = 'Headers Excluded: \n'
-    header_included_report = 'Headers Included: \n'
+def _derive_columns(column_values, batch):
+    n_rows = chunk_length(column_values)
 
-    if header_intersection:
-        intersection_header_labels = [str(x) for x in header_intersection]
-        intersection_header_indices = [str(x) for x in intersection_indices]
+    source_indices = sorted({idx for idx_sources, _function in batch for idx in idx_sources})
+    source_position = {idx: k for k, idx in enumerate(source_indices)}
+    argument_positions = [[source_position[idx] for idx in idx_sources] for idx_sources, _function in batch]
 
-        intersection_header_labels = str.join(', ', intersection_header_labels)
-        intersection_header_indices = str.join(', ', intersection_header_indices)
-    else:
-        intersection_header_labels = 'None'
-        intersection_header_indices = 'None'
+    derived_columns = [[] for k in range(len(batch))]
+    derivations = list(zip(derived_columns, [x[1] for x in batch], argument_positions))
 
-    if header_excluded:
-        excluded_header_labels = [str(x) for x in header_excluded]
-        excluded_header_indices = [str(x) for x in excluded_indices]
+    for row in itertools.islice(zip(*[column_values[idx] for idx in source_indices]), n_rows):
+        for derived_column, function, positions in derivations:
+            derived_column.append(function(*[row[k] for k in positions]))
 
-        excluded_header_labels = str.join(', ', excluded_header_labels)
-        excluded_header_indices = str.join(', ', excluded_header_indices)
-    else:
-        excluded_header_labels = 'None'
-        excluded_header_indices = 'None'
-                    
-    if header_included:
-        included_header_labels = [str(x) for x in header_included]
-        included_header_indices = [str(x) for x in included_indices]
+    column_values.extend(derived_columns)
 
-        included_header_labels = str.join(', ', included_header_labels)
-        included_header_indices = str.join(', ', included_header_indices)
-    else:
-        included_header_labels = 'None'
-        included_header_indices = 'None'
+#------------------------------------------------------------------------------    
+# Validation mode. Converts every column in one pass and, instead of stopping
+# at the first bad cell, records every non-empty value that failed to convert.
+# Only the first 'max_errors' rows and values of each column are kept; the
+# error mask and count always cover the whole column.
+#------------------------------------------------------------------------------    
+class column_errors(typing.NamedTuple):
+    idx_col             : int
+    attempted_data_type : str
+    error_mask          : numpy.ndarray
+    n_errors            : int
+    error_rows          : list
+    error_values        : list
 
-    header_intersection_report = (header_intersection_report 
-        + intersection_header_labels + '\n'
-        + intersection_header_indices + '\n')
+    def parsing_errors(self, file_name=''):
+        parse_error_list = []
+        for idx_row, problem_value in zip(self.error_rows, self.error_values):
+            parse_error = ParsingError()
+            parse_error.immediate_values(self.attempted_data_type, self.idx_col, idx_row, problem_value)
+            parse_error.file_name = file_name
+            parse_error_list.append(parse_error)
+        return parse_error_list
 
-    header_excluded_report = (header_excluded_report 
-        + excluded_header_labels + '\n'
-        + excluded_header_indices + '\n')
+#------------------------------------------------------------------------------    
+def _collect_column_errors(idx, attempted_data_type, error_mask, column, max_errors):
+    error_rows = numpy.flatnonzero(error_mask)
 
-    header_included_report = (header_included_report 
-        + included_header_labels + '\n'
-        + included_header_indices + '\n')
+    return column_errors(
+        idx_col             = idx,
+        attempted_data_type = attempted_data_type,
+        error_mask          = error_mask,
+        n_errors            = int(error_rows.size),
+        error_rows          = error_rows[:max_errors].tolist(),
+        error_values        = [column[k] for k in error_rows[:max_errors].tolist()]
+    )
 
-    return (header_intersection_report, header_excluded_report, header_included_report)             
+#------------------------------------------------------------------------------    
+def validate_table_data(column_values, idx_int=None, idx_float=None, idx_percentage=None, idx_date=None, idx_decimal=None, idx_boolean=None, boolean_string_values=None, max_errors=1000 ):
+
+    plan = parse_plan(idx_int=idx_int, idx_float=idx_float, idx_percentage=idx_percentage, idx_date=idx_date,
+                      idx_decimal=idx_decimal, idx_boolean=idx_boolean, boolean_string_values=boolean_string_values)
+
+    return plan.validate(column_values, max_errors)
 
 #------------------------------------------------------------------------------    
-# Helper function to parameterize the processing of  raw data files to clean output files.
-#------------------------------------------------------------------------------ 
-def process_data(input_file_path, output_file_path, data_processor, canonical_headers, preferred_headers):
-    # Read data file
-    with input_file_path.open('r', newline='', encoding='utf-8') as csv_file:
-        csv_reader = csv.reader(csv_file)    
-        (headers, column_values) = process_csv_data(csv_reader)
+# Column converters. Each takes a whole column of strings and converts it in
+# one batch, returning a masked array with nulls masked out.
+#------------------------------------------------------------------------------    
+def _text_list(column):
+    # Cells as a list of strings. Nulls left by earlier processing (e.g.
+    # sentinel_to_null) read as empty strings.
+    if isinstance(column, numpy.ndarray):
+        column = column.tolist()
+    if None in column:
+        return ['' if x is None else x for x in column]
+    return column
 
-    # Check File
-    (_header_intersection, _header_excluded, _header_included,
-     intersection_indices, excluded_indices, _included_indices)\
-          = check_column_names(canonical_headers, headers)
+#------------------------------------------------------------------------------    
+def _null_mask(values):
+    # Identity test; numpy.equal(values, None) is much slower on object arrays.
+    return numpy.array([x is None for x in values], dtype=bool)
 
-    column_values = normalize_columns(
-        canonical_headers, intersection_indices, excluded_indices, column_values)
+#------------------------------------------------------------------------------    
+def _object_column(parsed_values):
+    values = numpy.empty(len(parsed_values), dtype=object)
+    values[:] = parsed_values
 
-    # Process values
-    column_values = data_processor(column_values)
+    return numpy.ma.MaskedArray(values, mask=_null_mask(parsed_values))
 
-    # Write table to file
-    if output_file_path.exists():
-        # Write table to file, no header
-        with output_file_path.open('a', newline='', encoding='utf-8') as csv_file:
-            writer = csv.writer(csv_file)
-            writer.writerows(zip(*column_values))
-    else:
-        # Write table to file, with header
-        with output_file_path.open('w', newline='', encoding='utf-8') as csv_file:
-            writer = csv.writer(csv_file)
-            writer.writerow(preferred_headers)
-            writer.writerows(zip(*column_values))
+#------------------------------------------------------------------------------    
+def parse_float_column(column):
+    if isinstance(column, numpy.ndarray):
+        column = column.tolist()
+
+    null_mask = numpy.array([not x for x in column], dtype=bool)
+    values = numpy.zeros(len(column), dtype=numpy.float64)
+
+    try:
+        non_null_values = [x for x in column if x] if null_mask.any() else column
+        values[~null_mask] = numpy.fromiter(map(float, non_null_values), dtype=numpy.float64, count=len(non_null_values))
+    except (ValueError, TypeError):
+        # At least one value is not a number, so fall back to cell by cell.
+        parsed_values = [try_float_parse(x) if x else None for x in column]
+        null_mask = _null_mask(parsed_values)
+        values = numpy.array([0.0 if x is None else x for x in parsed_values], dtype=numpy.float64)
+
+    return numpy.ma.MaskedArray(values, mask=null_mask)
+
+#------------------------------------------------------------------------------    
+def parse_int_column(column):
+    float_column = parse_float_column(column)
+    float_values = float_column.filled(0.0)
+
+    # Same rule as try_int_parse: whole numbers only. Values outside the
+    # int64 range cannot be stored and are treated as null.
+    with numpy.errstate(invalid='ignore'):
+        is_integral = (numpy.isfinite(float_values)
+                       & (numpy.floor(float_values) == float_values)
+                       & (numpy.abs(float_values) < 2.0**63))
+
+    null_mask = numpy.ma.getmaskarray(float_column) | ~is_integral
+    values = numpy.where(null_mask, 0.0, float_values).astype(numpy.int64)
+
+    return numpy.ma.MaskedArray(values, mask=null_mask)
+
+#------------------------------------------------------------------------------    
+def parse_percentage_column(column):
+    # Anything without a trailing '%' becomes an empty string, i.e. null.
+    float_column = parse_float_column(_percentage_number_text(column))
+
+    return numpy.ma.MaskedArray(float_column.filled(0.0) / 100.0, mask=numpy.ma.getmaskarray(float_column))
+
+#------------------------------------------------------------------------------    
+# Date columns. The format is learned from the first values of the column and
+# the rest are converted with a precompiled pattern, falling back to
+# try_date_parse (dateutil) only for values that do not match.
+#------------------------------------------------------------------------------    
+class date_format(typing.NamedTuple):
+    name            : str
+    pattern         : typing.Pattern = None
+    strptime_format : str = None
+
+class date_parse_report(typing.NamedTuple):
+    date_format : str
+    n_values    : int
+    n_fast      : int
+    n_fallback  : int
+    n_null      : int
+
+_time_pattern = r'(?:[T ](?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2})(?:\.(?P<fraction>\d{1,6}))?)?)?'
+
+# Numeric formats are matched with a regex; formats with month names use strptime.
+date_format_list = [
+    date_format('%Y-%m-%d', re.compile(r'(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})' + _time_pattern)),
+    date_format('%Y/%m/%d', re.compile(r'(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})' + _time_pattern)),
+    date_format('%Y%m%d',   re.compile(r'(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})')),
+    date_format('%m/%d/%Y', re.compile(r'(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})' + _time_pattern)),
+    date_format('%m-%d-%Y', re.compile(r'(?P<month>\d{1,2})-(?P<day>\d{1,2})-(?P<year>\d{4})' + _time_pattern)),
+    date_format('%d-%b-%Y', strptime_format='%d-%b-%Y'),
+    date_format('%d %b %Y', strptime_format='%d %b %Y'),
+    date_format('%d %B %Y', strptime_format='%d %B %Y'),
+    date_format('%b %d, %Y', strptime_format='%b %d, %Y'),
+    date_format('%B %d, %Y', strptime_format='%B %d, %Y'),
+]
+
+#------------------------------------------------------------------------------    
+def try_date_format_parse(s, in_date_format):
+    if in_date_format.strptime_format:
+        try:
+            return datetime.datetime.strptime(s, in_date_format.strptime_format)
+        except ValueError:
+            return None
+
+    match = in_date_format.pattern.fullmatch(s.strip())
+    if match is None:
+        return None
+
+    date_parts = match.groupdict()
+
+    try:
+        return datetime.datetime(int(date_parts['year']), int(date_parts['month']), int(date_parts['day']),
+                                 int(date_parts.get('hour') or 0), int(date_parts.get('minute') or 0),
+                                 int(date_parts.get('second') or 0),
+                                 int((date_parts.get('fraction') or '0').ljust(6, '0')))
+    except ValueError:
+        # e.g. a day-first value such as 13/01/2020; dateutil sorts those out.
+        return None
+
+#------------------------------------------------------------------------------    
+def detect_date_format(sample_values):
+    # Pick the format matching the most sample values. A format is only
+    # trusted if it gives exactly what dateutil gives for every value it matches.
+    dateutil_values = [try_date_parse(x) for x in sample_values]
+
+    best_format = None
+    best_n_matched = 0
+
+    for i_date_format in date_format_list:
+        n_matched = 0
+        for value, dateutil_value in zip(sample_values, dateutil_values):
+            format_value = try_date_format_parse(value, i_date_format)
+            if format_value is None:
+                continue
+            if format_value != dateutil_value:
+                n_matched = 0
+                break
+            n_matched += 1
+
+        if n_matched > best_n_matched:
+            best_format = i_date_format
+            best_n_matched = n_matched
+
+    return best_format
+
+#------------------------------------------------------------------------------    
+def parse_date_column(column):
+    (date_column, _report) = parse_date_column_report(column)
+    return date_column
+
+#------------------------------------------------------------------------------    
+def parse_date_column_report(column, n_detect=20):
+    sample_values = list(itertools.islice((x for x in column if x), n_detect))
+    learned_format = detect_date_format(sample_values)
+
+    # Extracts repeat the same dates a lot, so convert each distinct string once.
+    converted_values = {}
+    parsed_values = []
+    n_fast = 0
+    n_fallback = 0
+
+    for value in column:
+        if not value:
+            parsed_values.append(None)
+            continue
+
+        if value in converted_values:
+            (date_value, is_fallback) = converted_values[value]
+        else:
+            date_value = None
+            if learned_format:
+                date_value = try_date_format_parse(value, learned_format)
+
+            is_fallback = date_value is None
+            if is_fallback:
+                date_value = try_date_parse(value)
+
+            converted_values[value] = (date_value, is_fallback)
+
+        if is_fallback:
+            n_fallback += 1
+        else:
+            n_fast += 1
+
+        parsed_values.append(date_value)
+
+    date_column = _object_column(parsed_values)
+
+    report = date_parse_report(
+        date_format = learned_format.name if learned_format else None,
+        n_values    = len(parsed_values),
+        n_fast      = n_fast,
+        n_fallback  = n_fallback,
+        n_null      = int(numpy.ma.count_masked(date_column))
+    )
+
+    return (date_column, report)
+
+#------------------------------------------------------------------------------    
+# Decimal and exact percentage columns. Clean columns go through the C
+# Decimal constructor in one map() call. The fixed point versions validate
+# and split plain numbers with NumPy string operations, then return int64
+# arrays of the value times 10**scale; only odd values (exponents, extra
+# fraction digits, ...) go through Decimal one at a time.
+#------------------------------------------------------------------------------    
+def parse_decimal_column(column):
+    try:
+        parsed_values = list(map(decimal.Decimal, column))
+    except (decimal.InvalidOperation, TypeError, ValueError):
+        # Nulls or bad values, so fall back to cell by cell.
+        parsed_values = [try_decimal_parse(x) if x else None for x in column]
+
+    return _object_column(parsed_values)
+
+#------------------------------------------------------------------------------    
+def _split_decimal_text(text_values):
+    # Split '[+-]digits[.digits]' into sign, integer and fraction digits.
+    text_values = numpy.char.strip(text_values)
+    is_negative = numpy.char.startswith(text_values, '-')
+    has_sign = is_negative | numpy.char.startswith(text_values, '+')
+
+    unsigned_text = numpy.char.lstrip(text_values, '+-')
+    (integer_text, _point, fraction_text) = numpy.char.partition(unsigned_text, '.').T
+
+    integer_length = numpy.char.str_len(integer_text)
+    fraction_length = numpy.char.str_len(fraction_text)
+
+    is_plain = (((numpy.char.str_len(text_values) - numpy.char.str_len(unsigned_text)) == has_sign)
+                & ((integer_length + fraction_length) > 0)
+                & (numpy.char.isdecimal(integer_text) | (integer_length == 0))
+                & (numpy.char.isdecimal(fraction_text) | (fraction_length == 0)))
+
+    return (is_plain, is_negative, integer_text, fraction_text)
+
+#------------------------------------------------------------------------------    
+def parse_decimal_column_fixed(column, scale=2):
+    text_values = _text_list(column)
+    if not len(text_values):
+        return numpy.ma.MaskedArray(numpy.zeros(0, dtype=numpy.int64), mask=numpy.zeros(0, dtype=bool))
+
+    # Cells too long to be exact are blanked in the string array, which is
+    # as wide as its longest cell, and parsed one by one below.
+    is_long = numpy.fromiter(map(len, text_values), dtype=numpy.int64, count=len(text_values)) > 40
+    short_text = ['' if x else y for (x, y) in zip(is_long.tolist(), text_values)] if is_long.any() else text_values
+    (is_plain, is_negative, integer_text, fraction_text) = _split_decimal_text(numpy.array(short_text, dtype=numpy.str_))
+
+    # Exact whenever there are at most 'scale' fraction digits and the result
+    # fits in int64; everything else is rounded (half even) through Decimal.
+    is_exact = (is_plain & ~is_long
+                & (numpy.char.str_len(fraction_text) <= scale)
+                & (numpy.char.str_len(numpy.char.lstrip(integer_text, '0')) + scale <= 18))
+
+    values = numpy.zeros(len(text_values), dtype=numpy.int64)
+    null_mask = ~is_exact
+
+    if is_exact.any():
+        digit_text = numpy.char.add(integer_text[is_exact], numpy.char.ljust(fraction_text[is_exact], scale, '0'))
+        digit_text = numpy.where(numpy.char.str_len(digit_text) == 0, '0', digit_text)
+        exact_values = numpy.fromiter(map(int, digit_text.tolist()), dtype=numpy.int64, count=digit_text.size)
+        values[is_exact] = numpy.where(is_negative[is_exact], -exact_values, exact_values)
+
+    for k in numpy.flatnonzero(~is_exact).tolist():
+        decimal_value = try_decimal_parse(text_values[k]) if text_values[k] else None
+        if decimal_value is not None and decimal_value.is_finite():
+            fixed_value = int(decimal_value.scaleb(scale).to_integral_value(rounding=decimal.ROUND_HALF_EVEN))
+            if abs(fixed_value) < 2**63:
+                values[k] = fixed_value
+                null_mask[k] = False
+
+    return numpy.ma.MaskedArray(values, mask=null_mask)
+
+#------------------------------------------------------------------------------    
+def _percentage_number_text(column):
+    # Same rule as try_percentage_parse: only values ending in '%' count.
+    text_values = [x.strip() for x in _text_list(column)]
+    return [x.replace('%', '') if x.endswith('%') else '' for x in text_values]
+
+#------------------------------------------------------------------------------    
+def parse_percentage_decimal_column(column):
+    decimal_column = parse_decimal_column(_percentage_number_text(column))
+    values = numpy.ma.getdata(decimal_column)
+    valid_indices = numpy.flatnonzero(~numpy.ma.getmaskarray(decimal_column))
+
+    values[valid_indices] = [x.scaleb(-2) for x in values[valid_indices].tolist()]
+
+    return decimal_column
+
+#------------------------------------------------------------------------------    
+def parse_percentage_column_fixed(column, scale=4):
+    # e.g. '12.5%' with scale 4 is 1250, i.e. 0.1250.
+    if scale >= 2:
+        return parse_decimal_column_fixed(_percentage_number_text(column), scale - 2)
+
+    decimal_column = parse_percentage_decimal_column(column)
+    return parse_decimal_column_fixed([str(x) if x is not None else '' for x in decimal_column.tolist()], scale)
+
+#------------------------------------------------------------------------------    
+def parse_boolean_column(column, true_value='True', false_value='False'):
+    # Compare as objects; a string array would pad every cell to the longest.
+    text_values = numpy.empty(len(column), dtype=object)
+    text_values[:] = _text_list(column)
+
+    true_mask = (text_values == true_value).astype(bool)
+    false_mask = (text_values == false_value).astype(bool)
+    null_mask = (text_values == '').astype(bool)
+
+    # Values that are neither true, false nor empty; see str_to_bool.
+    invalid_mask = ~(true_mask | false_mask | null_mask)
+
+    return (numpy.ma.MaskedArray(true_mask, mask=null_mask | invalid_mask), invalid_mask)
+
+#------------------------------------------------------------------------------    
+def process_csv_data(csv_reader, has_headers=True, chunk_size=None):    
+    # Generator mode: return the headers and a generator of column blocks.
+    if chunk_size:
+        return process_csv_data_chunks(csv_reader, has_headers, chunk_size)
+
+    if has_headers:
+        column_headers = next(csv_reader)
+        
+        n_columns = len(column_headers)
+        column_values = [[] for k in range(n_columns)] 
+    else:
+        column_headers = []
+        first_row = next(csv_reader)
+        n_columns = len(first_row)
+
+        column_values = []
+        for k in range(n_columns):
+            column_values.append([first_row[k]])        
+
+    for row in csv_reader:        
+        for idx in range(len(row)):
+            column_values[idx].append(row[idx])
+                
+    return (column_headers, column_values)
+
+#------------------------------------------------------------------------------    
+# Chunked reading. Rows are read lazily into blocks of at most 'chunk_size'
+# rows, so the csv file must stay open while the blocks are consumed.
+#------------------------------------------------------------------------------    
+def process_csv_data_chunks(csv_reader, has_headers=True, chunk_size=100000):    
+    if has_headers:
+        column_headers = next(csv_reader)
+        n_columns = len(column_headers)
+        first_rows = []
+    else:
+        column_headers = []
+        first_row = next(csv_reader)
+        n_columns = len(first_row)
+        first_rows = [first_row]
+
+    csv_rows = itertools.chain(first_rows, csv_reader)
+
+    return (column_headers, _generate_csv_chunks(csv_rows, n_columns, chunk_size))
+
+#------------------------------------------------------------------------------    
+def _generate_csv_chunks(csv_rows, n_columns, chunk_size):    
+    while True:
+        column_values = [[] for k in range(n_columns)]
+        n_rows = 0
+
+        for row in itertools.islice(csv_rows, chunk_size):
+            for idx in range(len(row)):
+                column_values[idx].append(row[idx])
+            n_rows += 1
+
+        if n_rows == 0:
+            return
+
+        yield column_values
+
+        if n_rows < chunk_size:
+            return
+
+#------------------------------------------------------------------------------    
+def chunk_length(column_values):
+    # Excluded columns are infinite iterators, so measure a real column.
+    return next((len(x) for x in column_values if hasattr(x, '__len__')), 0)
+
+#------------------------------------------------------------------------------    
+def normalize_column_chunks(canonical_headers, intersection_indices, excluded_indices, column_chunks):    
+    for column_values in column_chunks:
+        yield normalize_columns(canonical_headers, intersection_indices, excluded_indices, column_values)
+
+#------------------------------------------------------------------------------    
+def process_column_chunks(data_processor, column_chunks):    
+    # Apply 'data_processor' block by block. Parse errors report the row
+    # number in the whole file, not in the block.
+    idx_row_offset = 0
+
+    for column_values in column_chunks:
+        n_rows = chunk_length(column_values)
+
+        try:
+            column_values = data_processor(column_values)
+        except ParsingError as parse_error:
+            parse_error.idx_row += idx_row_offset
+            raise parse_error
+
+        idx_row_offset += n_rows
+
+        yield column_values
+
+#------------------------------------------------------------------------------    
+def write_csv_chunks(output_file_path, column_chunks, preferred_headers):    
+    # Append to an existing file, otherwise start a new one with a header. If
+    # a chunk fails, e.g. with a ParsingError, the rows already written are
+    # removed so that a rerun does not duplicate them.
+    write_header = not output_file_path.exists()
+    start_size = 0 if write_header else output_file_path.stat().st_size
+    n_rows = 0
+
+    try:
+        with output_file_path.open('w' if write_header else 'a', newline='', encoding='utf-8') as csv_file:
+            writer = csv.writer(csv_file)
+
+            if write_header:
+                writer.writerow(preferred_headers)
+
+            for column_values in column_chunks:
+                writer.writerows(zip(*column_values))
+                n_rows += chunk_length(column_values)
+    except BaseException:
+        if write_header:
+            output_file_path.unlink(missing_ok=True)
+        else:
+            os.truncate(output_file_path, start_size)
+        raise
+
+    return n_rows
+
+#------------------------------------------------------------------------------    
+# Memory-mapped reading. One pass over the file records the byte offsets of
+# the fields in the columns we keep; only those fields are ever decoded.
+# Fields missing from short rows read as empty strings.
+#------------------------------------------------------------------------------    
+class mmap_csv_table:
+    block_size = 1 << 22
+
+    def __init__(self, input_file_path, keep_headers=None, has_headers=True, encoding='utf-8'):
+        self.encoding = encoding
+
+        self._file = input_file_path.open('rb')
+        file_size = os.fstat(self._file.fileno()).st_size
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if file_size else b''
+
+        # Headers are always decoded in full
+        if has_headers and file_size:
+            (header_fields, position) = self._scan_record(0)
+            self.headers = [self._decode_field(*x) for x in header_fields]
+            n_columns = len(self.headers)
+        else:
+            self.headers = []
+            position = 0
+            n_columns = len(self._scan_record(0)[0]) if file_size else 0
+
+        if keep_headers is None or not has_headers:
+            self.keep_indices = list(range(n_columns))
+        else:
+            keep_set = set(keep_headers)
+            self.keep_indices = [k for k, x in enumerate(self.headers) if x in keep_set]
+
+        self._build_index(position)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+
+    def _scan_record(self, position):
+        # Slow path for records with quotes; quoted fields may span lines.
+        buffer = self._buffer
+        size = len(buffer)
+
+        fields = []
+        field_start = position
+        is_quoted = False
+        idx = position
+
+        is_unclosed = False
+
+        while idx < size:
+            c = buffer[idx]
+            if c == 34 and idx == field_start:
+                # As in csv.reader, only a quote that opens a field starts a
+                # quoted field. Jump to the closing quote, stepping over
+                # doubled quotes; an unclosed quote runs to the end of file.
+                is_quoted = True
+                idx = idx + 1
+                while True:
+                    idx = buffer.find(b'"', idx)
+                    if idx == -1:
+                        idx = size
+                        break
+                    if buffer[idx+1:idx+2] == b'"':
+                        idx += 2
+                    else:
+                        break
+                if idx >= size:
+                    is_unclosed = True
+                    break
+            elif c == 44:
+                fields.append((field_start, idx, is_quoted))
+                field_start = idx + 1
+                is_quoted = False
+            elif c == 10:
+                break
+            idx += 1
+
+        field_end = idx
+        if not is_unclosed and field_end > field_start and buffer[field_end-1] == 13:
+            field_end -= 1
+        fields.append((field_start, field_end, is_quoted))
+
+        return (fields, idx + 1)
+
+    def _build_index(self, position):
+        buffer = self._buffer
+        size = len(buffer)
+
+        n_keep = len(self.keep_indices)
+        self._field_starts = [array.array('q') for k in range(n_keep)]
+        self._field_ends = [array.array('q') for k in range(n_keep)]
+        self._field_quoted = [array.array('B') for k in range(n_keep)]
+        self.n_rows = 0
+
+        while position < size:
+            # Take a block of whole lines
+            block_end = min(position + self.block_size, size)
+            if block_end < size:
+                block_end = buffer.rfind(b'\n', position, block_end) + 1
+                if block_end == 0:
+                    block_end = buffer.find(b'\n', position) + 1 or size
+
+            # Fast path: lines before the first quote are indexed in bulk
+            quote = buffer.find(b'"', position, block_end)
+            plain_end = block_end if quote == -1 else buffer.rfind(b'\n', position, quote) + 1 or position
+            if plain_end > position:
+                self._index_plain_lines(position, plain_end)
+                position = plain_end
+                continue
+
+            # Slow path: one record with quotes, which may span lines
+            (fields, position) = self._scan_record(position)
+
+            n_fields = len(fields)
+            for slot, idx in enumerate(self.keep_indices):
+                (start, end, is_quoted) = fields[idx] if idx < n_fields else (0, 0, False)
+                self._field_starts[slot].append(start)
+                self._field_ends[slot].append(end)
+                self._field_quoted[slot].append(is_quoted)
+
+            self.n_rows += 1
+
+    def _index_plain_lines(self, position, end):
+        # Lines in [position, end) have no quotes, so every comma splits a
+        # field. Find the commas and line breaks with numpy; field k of a line
+        # runs from after its k-th comma to its (k+1)-th comma or line end.
+        data = numpy.frombuffer(self._buffer, dtype=numpy.uint8, count=end - position, offset=position)
+
+        line_ends = numpy.flatnonzero(data == 10)
+        if len(line_ends) == 0 or line_ends[-1] != len(data) - 1:
+            line_ends = numpy.append(line_ends, len(data))
+        line_starts = numpy.concatenate(([0], line_ends[:-1] + 1))
+
+        # Drop a trailing CR, then skip blank lines, like csv.reader does
+        has_cr = (line_ends > line_starts) & (data[numpy.maximum(line_ends - 1, 0)] == 13)
+        record_ends = line_ends - has_cr
+        is_blank = record_ends == line_starts
+        if is_blank.any():
+            line_starts = line_starts[~is_blank]
+            record_ends = record_ends[~is_blank]
+
+        commas = numpy.flatnonzero(data == 44)
+        first_comma = numpy.searchsorted(commas, line_starts)
+        n_commas = numpy.searchsorted(commas, record_ends) - first_comma
+
+        n_lines = len(line_starts)
+        for slot, idx in enumerate(self.keep_indices):
+            is_present = n_commas >= idx
+            has_comma_after = n_commas > idx
+
+            if idx == 0:
+                starts = line_starts.copy()
+            else:
+                starts = numpy.zeros(n_lines, dtype=numpy.int64)
+                starts[is_present] = commas[first_comma[is_present] + idx - 1] + 1
+
+            ends = numpy.where(is_present, record_ends, 0)
+            ends[has_comma_after] = commas[first_comma[has_comma_after] + idx]
+
+            starts = numpy.where(is_present, starts + position, 0)
+            ends = numpy.where(is_present, ends + position, 0)
+
+            self._field_starts[slot].frombytes(starts.astype(numpy.int64).tobytes())
+            self._field_ends[slot].frombytes(ends.astype(numpy.int64).tobytes())
+            self._field_quoted[slot].frombytes(bytes(n_lines))
+
+        self.n_rows += n_lines
+
+    def _decode_field(self, start, end, is_quoted):
+        text = self._buffer[start:end].decode(self.encoding)
+        if is_quoted:
+            text = next(csv.reader(io.StringIO(text)))[0]
+        return text
+
+    def column(self, idx):
+        slot = self.keep_indices.index(idx)
+        buffer = self._buffer
+        encoding = self.encoding
+
+        starts = self._field_starts[slot]
+        ends = self._field_ends[slot]
+        quoted = self._field_quoted[slot]
+
+        if not any(quoted):
+            return [buffer[a:b].decode(encoding) for a, b in zip(starts, ends)]
+
+        return [self._decode_field(a, b, q) for a, b, q in zip(starts, ends, quoted)]
+
+    def column_values(self):
+        # Same layout as process_csv_data, with None for columns not kept.
+        column_values = [None] * max(len(self.headers), max(self.keep_indices, default=-1) + 1)
+        for idx in self.keep_indices:
+            column_values[idx] = self.column(idx)
+        return column_values
+
+#------------------------------------------------------------------------------    
+def process_csv_mmap(input_file_path, keep_headers=None, has_headers=True, encoding='utf-8'):
+    with mmap_csv_table(input_file_path, keep_headers, has_headers, encoding) as csv_table:
+        return (csv_table.headers, csv_table.column_values())
+
+#------------------------------------------------------------------------------    
+def check_column_names(canonical_headers, other_headers):    
+    return tuple(compile_column_mapping(canonical_headers, other_headers)[:6])
+
+#------------------------------------------------------------------------------    
+# Header mapping plans. compile_column_mapping works out, once per
+# (canonical_headers, other_headers) signature, where each canonical column
+# comes from. Optional 'header_aliases' rename file headers to canonical ones
+# and 'default_values' fill canonical columns missing from the file.
+# The first six fields are the check_column_names output.
+#------------------------------------------------------------------------------    
+class column_mapping(typing.NamedTuple):
+    header_intersection  : set
+    header_excluded      : set
+    header_included      : set
+    intersection_indices : list
+    excluded_indices     : list
+    included_indices     : list
+    source_indices       : list
+    default_values       : list
+
+    def apply(self, column_values):
+        # Rename, reorder and default-fill in one pass. Default-filled columns
+        # are real lists, so converters can parse them; columns without a
+        # default stay excluded (itertools.repeat(None)).
+        n_rows = chunk_length(column_values)
+        return [column_values[k] if k >= 0 else (itertools.repeat(x) if x is None else [x] * n_rows)
+                for k, x in zip(self.source_indices, self.default_values)]
+
+    def report(self):
+        return column_report(*self[:6])
+
+_column_mapping_cache = {}
+
+#------------------------------------------------------------------------------    
+def clear_column_mapping_cache():
+    _column_mapping_cache.clear()
+
+#------------------------------------------------------------------------------    
+def compile_column_mapping(canonical_headers, other_headers, header_aliases=None, default_values=None):
+    cache_key = (tuple(canonical_headers), tuple(other_headers),
+                 tuple(header_aliases.items()) if header_aliases else None,
+                 tuple(default_values.items()) if default_values else None)
+
+    if cache_key in _column_mapping_cache:
+        return _column_mapping_cache[cache_key]
+
+    if header_aliases:
+        other_headers = [header_aliases.get(x, x) for x in other_headers]
+
+    # First position of each header, as list.index would give.
+    canonical_positions = {}
+    for k, x in enumerate(canonical_headers):
+        canonical_positions.setdefault(x, k)
+
+    other_positions = {}
+    for k, x in enumerate(other_headers):
+        other_positions.setdefault(x, k)
+
+    canonical_set = set(canonical_positions)
+    other_set = set(other_positions)
+
+    header_intersection = set.intersection(canonical_set, other_set)
+    header_excluded = set.difference(canonical_set, other_set)
+    header_included = set.difference(other_set, canonical_set)
+
+    intersection_indices = [[canonical_positions[x] for x in header_intersection],
+                            [other_positions[x] for x in header_intersection]]
+
+    excluded_indices = [canonical_positions[x] for x in header_excluded]
+    included_indices = [other_positions[x] for x in header_included]
+
+    default_values = default_values or {}
+
+    mapping = column_mapping(
+        header_intersection  = header_intersection,
+        header_excluded      = header_excluded,
+        header_included      = header_included,
+        intersection_indices = intersection_indices,
+        excluded_indices     = excluded_indices,
+        included_indices     = included_indices,
+        source_indices       = [other_positions.get(x, -1) for x in canonical_headers],
+        default_values       = [default_values.get(x) for x in canonical_headers]
+    )
+
+    _column_mapping_cache[cache_key] = mapping
+
+    return mapping
+
+#------------------------------------------------------------------------------    
+def normalize_columns(canonical_headers, intersection_indices, excluded_indices, column_values):    
+    normalized_column_values = [None] * len(canonical_headers)
+
+    for idx0, idx1 in zip(intersection_indices[0], intersection_indices[1]):
+        normalized_column_values[idx0] = column_values[idx1]
+
+    for idx0 in excluded_indices:
+        normalized_column_values[idx0] = itertools.repeat(None)
+                    
+    return normalized_column_values
+
+#------------------------------------------------------------------------------    
+def column_report(header_intersection, header_excluded, header_included, intersection_indices, excluded_indices, included_indices):
+    header_intersection_report = 'Header Intersection: \n'
+    header_excluded_report = 'Headers Excluded: \n'
+    header_included_report = 'Headers Included: \n'
+
+    if header_intersection:
+        intersection_header_labels = [str(x) for x in header_intersection]
+        intersection_header_indices = [str(x) for x in intersection_indices]
+
+        intersection_header_labels = str.join(', ', intersection_header_labels)
+        intersection_header_indices = str.join(', ', intersection_header_indices)
+    else:
+        intersection_header_labels = 'None'
+        intersection_header_indices = 'None'
+
+    if header_excluded:
+        excluded_header_labels = [str(x) for x in header_excluded]
+        excluded_header_indices = [str(x) for x in excluded_indices]
+
+        excluded_header_labels = str.join(', ', excluded_header_labels)
+        excluded_header_indices = str.join(', ', excluded_header_indices)
+    else:
+        excluded_header_labels = 'None'
+        excluded_header_indices = 'None'
+                    
+    if header_included:
+        included_header_labels = [str(x) for x in header_included]
+        included_header_indices = [str(x) for x in included_indices]
+
+        included_header_labels = str.join(', ', included_header_labels)
+        included_header_indices = str.join(', ', included_header_indices)
+    else:
+        included_header_labels = 'None'
+        included_header_indices = 'None'
+
+    header_intersection_report = (header_intersection_report 
+        + intersection_header_labels + '\n'
+        + intersection_header_indices + '\n')
+
+    header_excluded_report = (header_excluded_report 
+        + excluded_header_labels + '\n'
+        + excluded_header_indices + '\n')
+
+    header_included_report = (header_included_report 
+        + included_header_labels + '\n'
+        + included_header_indices + '\n')
+
+    return (header_intersection_report, header_excluded_report, header_included_report)             
+
+#------------------------------------------------------------------------------    
+def file_fingerprint(input_file_path, known=None):
+    # Path, size, mtime and content hash of a file. The hash is only
+    # recomputed when size or mtime differ from the 'known' fingerprint.
+    file_stat = input_file_path.stat()
+
+    if known and known['size'] == file_stat.st_size and known['mtime_ns'] == file_stat.st_mtime_ns:
+        return known
+
+    content_hash = hashlib.blake2b()
+    with input_file_path.open('rb') as binary_file:
+        for block in iter(lambda: binary_file.read(2**20), b''):
+            content_hash.update(block)
+
+    return {'path': str(input_file_path.resolve()), 'size': file_stat.st_size,
+            'mtime_ns': file_stat.st_mtime_ns, 'content_hash': content_hash.hexdigest()}
+
+#------------------------------------------------------------------------------    
+# On-disk cache of normalized columns, stored as compressed npz files keyed by
+# the file fingerprint (path, size, mtime, content hash) and canonical headers.
+# Least recently used entries are evicted once the cache exceeds 'max_bytes'.
+#------------------------------------------------------------------------------    
+# Text columns are cached as one utf-8 buffer plus int64 offsets, cell k being
+# buffer[offsets[k]:offsets[k+1]], so a long cell only costs its own bytes.
+# None cells are empty in the buffer and flagged in a null mask.
+#------------------------------------------------------------------------------    
+def _encode_text_column(column):
+    null_mask = numpy.array([x is None for x in column], dtype=bool)
+    encoded = [b'' if x is None else x.encode('utf-8') for x in column]
+
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.fromiter(map(len, encoded), dtype=numpy.int64, count=len(encoded)), out=offsets[1:])
+
+    return (numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8), offsets, null_mask)
+
+#------------------------------------------------------------------------------    
+def _decode_text_column(text_buffer, offsets, null_mask):
+    text_bytes = text_buffer.tobytes()
+    bounds = zip(offsets[:-1].tolist(), offsets[1:].tolist())
+
+    try:
+        # ASCII text: byte offsets are character offsets, so decode once
+        text = text_bytes.decode('ascii')
+        column = [text[a:b] for (a, b) in bounds]
+    except UnicodeDecodeError:
+        column = [text_bytes[a:b].decode('utf-8') for (a, b) in bounds]
+
+    for idx in numpy.flatnonzero(null_mask).tolist():
+        column[idx] = None
+
+    return column
+
+#------------------------------------------------------------------------------    
+#------------------------------------------------------------------------------    
+class parsed_table_cache:
+    index_file_name = 'cache_index.json'
+    # Part of every cache key, so files written in an older layout are not read
+    cache_format = 2
+
+    def __init__(self, cache_directory, max_bytes=2**30):
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self._index_path = self.cache_directory.joinpath(self.index_file_name)
+
+        if self._index_path.exists():
+            self._index = json.loads(self._index_path.read_text(encoding='utf-8'))
+        else:
+            self._index = {'fingerprints': {}, 'entries': {}}
+
+    def _write_index(self):
+        self._index_path.write_text(json.dumps(self._index), encoding='utf-8')
+
+    def fingerprint(self, input_file_path):
+        file_path = str(input_file_path.resolve())
+
+        known = file_fingerprint(input_file_path, self._index['fingerprints'].get(file_path))
+        self._index['fingerprints'][file_path] = known
+
+        return known
+
+    def cache_key(self, input_file_path, canonical_headers):
+        key_source = json.dumps([self.cache_format, self.fingerprint(input_file_path), list(canonical_headers)])
+        return hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    def load(self, input_file_path, canonical_headers):
+        # Returns normalized column values, or None if the file is not cached.
+        cache_key = self.cache_key(input_file_path, canonical_headers)
+        entry = self._index['entries'].get(cache_key)
+        cache_file_path = self.cache_directory.joinpath(cache_key + '.npz')
+
+        if entry is None or not cache_file_path.exists():
+            return None
+
+        with numpy.load(cache_file_path) as npz_file:
+            excluded_indices = set(json.loads(str(npz_file['excluded_indices'])))
+            column_values = [itertools.repeat(None) if k in excluded_indices else
+                             _decode_text_column(npz_file['column_' + str(k)], npz_file['offsets_' + str(k)], npz_file['nulls_' + str(k)])
+                             for k in range(len(canonical_headers))]
+
+        entry['last_access'] = time.time()
+        self._write_index()
+
+        return column_values
+
+    def store(self, input_file_path, canonical_headers, column_values):
+        cache_key = self.cache_key(input_file_path, canonical_headers)
+        cache_file_path = self.cache_directory.joinpath(cache_key + '.npz')
+
+        excluded_indices = [k for k, x in enumerate(column_values) if isinstance(x, itertools.repeat)]
+        column_arrays = {}
+        for k, x in enumerate(column_values):
+            if k not in excluded_indices:
+                (column_arrays['column_' + str(k)], column_arrays['offsets_' + str(k)], column_arrays['nulls_' + str(k)]) = _encode_text_column(x)
+
+        with cache_file_path.open('wb') as npz_file:
+            numpy.savez_compressed(npz_file, excluded_indices=numpy.array(json.dumps(excluded_indices)), **column_arrays)
+
+        self._index['entries'][cache_key] = {'size_bytes': cache_file_path.stat().st_size, 'last_access': time.time()}
+        self.evict()
+        self._write_index()
+
+    def evict(self):
+        entries = self._index['entries']
+        total_bytes = sum(x['size_bytes'] for x in entries.values())
+
+        for cache_key in sorted(entries, key=lambda x: entries[x]['last_access']):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= entries[cache_key]['size_bytes']
+            self.cache_directory.joinpath(cache_key + '.npz').unlink(missing_ok=True)
+            del entries[cache_key]
+
+    def clear(self):
+        for cache_key in list(self._index['entries']):
+            self.cache_directory.joinpath(cache_key + '.npz').unlink(missing_ok=True)
+        self._index = {'fingerprints': {}, 'entries': {}}
+        self._write_index()
+
+#------------------------------------------------------------------------------    
+# Helper function to parameterize the processing of  raw data files to clean output files.
+#------------------------------------------------------------------------------ 
+def process_data(input_file_path, output_file_path, data_processor, canonical_headers, preferred_headers, chunk_size=None, use_mmap=False, table_cache=None):
+    if chunk_size:
+        # Stream the file through in blocks of 'chunk_size' rows. Nothing is
+        # left in the output file if any block fails.
+        with input_file_path.open('r', newline='', encoding='utf-8') as csv_file:
+            csv_reader = csv.reader(csv_file)    
+            (headers, column_chunks) = process_csv_data(csv_reader, chunk_size=chunk_size)
+
+            mapping = compile_column_mapping(canonical_headers, headers)
+            column_chunks = map(mapping.apply, column_chunks)
+
+            column_chunks = process_column_chunks(data_processor, column_chunks)
+
+            write_csv_chunks(output_file_path, column_chunks, preferred_headers)
+
+        return
+
+    # Normalized columns may already be cached from an earlier run
+    column_values = table_cache.load(input_file_path, canonical_headers) if table_cache else None
+
+    if column_values is None:
+        # Read data file
+        if use_mmap:
+            # Only decode the columns listed in canonical_headers
+            (headers, column_values) = process_csv_mmap(input_file_path, keep_headers=canonical_headers)
+        else:
+            with input_file_path.open('r', newline='', encoding='utf-8') as csv_file:
+                csv_reader = csv.reader(csv_file)    
+                (headers, column_values) = process_csv_data(csv_reader)
+
+        # Check File
+        column_values = compile_column_mapping(canonical_headers, headers).apply(column_values)
+
+        if table_cache:
+            table_cache.store(input_file_path, canonical_headers, column_values)
+
+    # Process values
+    column_values = data_processor(column_values)
+
+    # Write table to file, with a header if the file is new
+    write_csv_chunks(output_file_path, [column_values], preferred_headers)
+
+#------------------------------------------------------------------------------    
+# Batch version of process_data. Files are read, normalized and processed in a
+# pool of worker processes and written by this process to one open output
+# file. 'data_processor' must be picklable, i.e. a module level function.
+#------------------------------------------------------------------------------ 
+class file_result(typing.NamedTuple):
+    input_file_path : object
+    n_rows          : int
+    error           : Exception
+
+#------------------------------------------------------------------------------ 
+def _process_file_rows(input_file_path, data_processor, canonical_headers):
+    try:
+        with input_file_path.open('r', newline='', encoding='utf-8') as csv_file:
+            csv_reader = csv.reader(csv_file)    
+            (headers, column_values) = process_csv_data(csv_reader)
+
+        column_values = compile_column_mapping(canonical_headers, headers).apply(column_values)
+
+        column_values = data_processor(column_values)
+
+        return (input_file_path, list(zip(*column_values)), None)
+    except Exception as error:
+        # Hand the failure back so one bad file does not stop the batch.
+        if isinstance(error, ParsingError):
+            error.file_name = input_file_path.name
+        return (input_file_path, None, error)
+
+#------------------------------------------------------------------------------ 
+def print_batch_progress(n_done, n_total, result):
+    mm.misc_utilities.print_progress_bar(n_done, n_total, prefix='Files ', length=50)
+
+#------------------------------------------------------------------------------ 
+def process_data_batch(input_file_paths, output_file_path, data_processor, canonical_headers, preferred_headers,
+                       max_workers=None, ordered=True, progress_callback=None):
+    # Write results in input order ('ordered') or as files finish. At most a
+    # few files per worker are held in memory at once.
+    input_file_paths = list(input_file_paths)
+    n_total = len(input_file_paths)
+    n_window = 2 * (max_workers or os.cpu_count() or 1)
+
+    file_results = []
+    write_header = not output_file_path.exists()
+
+    with output_file_path.open('w' if write_header else 'a', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+
+        if write_header:
+            writer.writerow(preferred_headers)
+
+        def write_result(future):
+            (input_file_path, rows, error) = future.result()
+
+            if error is None:
+                writer.writerows(rows)
+                result = file_result(input_file_path, len(rows), None)
+            else:
+                result = file_result(input_file_path, 0, error)
+
+            file_results.append(result)
+
+            if progress_callback:
+                progress_callback(len(file_results), n_total, result)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending_paths = iter(input_file_paths)
+            in_flight = collections.deque()
+
+            for input_file_path in itertools.islice(pending_paths, n_window):
+                in_flight.append(executor.submit(_process_file_rows, input_file_path, data_processor, canonical_headers))
+
+            while in_flight:
+                if ordered:
+                    write_result(in_flight.popleft())
+                    n_finished = 1
+                else:
+                    (done, _not_done) = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        in_flight.remove(future)
+                        write_result(future)
+                    n_finished = len(done)
+
+                for input_file_path in itertools.islice(pending_paths, n_finished):
+                    in_flight.append(executor.submit(_process_file_rows, input_file_path, data_processor, canonical_headers))
+
+    return file_results
+
+#------------------------------------------------------------------------------    
+# Incremental version of process_data. A manifest next to the output records
+# each input's fingerprint and the byte range of its rows in the output, so a
+# re-run only processes new or changed inputs. Rows of unchanged inputs are
+# copied byte for byte when the output has to be rewritten.
+#------------------------------------------------------------------------------ 
+class incremental_report(typing.NamedTuple):
+    n_unchanged : int
+    n_added     : int
+    n_changed   : int
+    n_removed   : int
+
+#------------------------------------------------------------------------------ 
+def _csv_bytes(rows):
+    text_buffer = io.StringIO(newline='')
+    csv.writer(text_buffer).writerows(rows)
+    return text_buffer.getvalue().encode('utf-8')
+
+#------------------------------------------------------------------------------ 
+def _copy_byte_range(source_file, target_file, offset, n_bytes, block_size=2**20):
+    source_file.seek(offset)
+    while n_bytes > 0:
+        block = source_file.read(min(block_size, n_bytes))
+        if not block:
+            break
+        target_file.write(block)
+        n_bytes -= len(block)
+
+#------------------------------------------------------------------------------ 
+def process_data_incremental(input_file_paths, output_file_path, data_processor, canonical_headers, preferred_headers, manifest_path=None):
+    if manifest_path is None:
+        manifest_path = output_file_path.with_name(output_file_path.name + '.manifest.json')
+
+    # Plain function processors are known by name only, so changing the body
+    # of the same function is not detected.
+    settings = {
+        'canonical_headers': list(canonical_headers),
+        'preferred_headers': list(preferred_headers),
+        'data_processor'   : callable_signature(data_processor)
+    }
+
+    # Without both files we cannot tell what the output holds, and output made
+    # with other headers or another processor is stale, so start over.
+    if output_file_path.exists() and manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+        if manifest.get('settings') != settings:
+            manifest = {'header_bytes': 0, 'segments': []}
+    else:
+        manifest = {'header_bytes': 0, 'segments': []}
+
+    manifest['settings'] = settings
+
+    segment_dict = {x['path']: x for x in manifest['segments']}
+    input_file_paths = list(input_file_paths)
+    input_path_set = {str(x.resolve()) for x in input_file_paths}
+
+    kept_segments = []
+    stale_segments = []
+    pending_paths = []
+    n_changed = 0
+
+    for input_file_path in input_file_paths:
+        segment = segment_dict.get(str(input_file_path.resolve()))
+        if segment is None:
+            pending_paths.append(input_file_path)
+            continue
+
+        fingerprint = file_fingerprint(input_file_path, segment)
+        if fingerprint['content_hash'] == segment['content_hash']:
+            segment.update(fingerprint)
+            kept_segments.append(segment)
+        else:
+            stale_segments.append(segment)
+            pending_paths.append(input_file_path)
+            n_changed += 1
+
+    removed_segments = [x for x in manifest['segments'] if x['path'] not in input_path_set]
+    stale_segments.extend(removed_segments)
+
+    def append_segments(output_file):
+        for input_file_path in pending_paths:
+            (_input_file_path, rows, error) = _process_file_rows(input_file_path, data_processor, canonical_headers)
+            if error is not None:
+                raise error
+
+            segment_bytes = _csv_bytes(rows)
+            segment = file_fingerprint(input_file_path)
+            segment.update({'offset': output_file.tell(), 'n_bytes': len(segment_bytes), 'n_rows': len(rows)})
+
+            output_file.write(segment_bytes)
+            kept_segments.append(segment)
+
+    if manifest['segments'] and not stale_segments:
+        # Only additions: drop anything past the last recorded segment, then append.
+        end_offset = max([x['offset'] + x['n_bytes'] for x in kept_segments] + [manifest['header_bytes']])
+
+        with output_file_path.open('r+b') as output_file:
+            output_file.truncate(end_offset)
+            output_file.seek(end_offset)
+            append_segments(output_file)
+    else:
+        # Rewrite: header, unchanged segments copied as bytes, then new rows.
+        header_bytes = _csv_bytes([preferred_headers])
+        temp_file_path = output_file_path.with_name(output_file_path.name + '.tmp')
+        old_segments = list(kept_segments)
+        kept_segments.clear()
+
+        with temp_file_path.open('wb') as output_file:
+            output_file.write(header_bytes)
+
+            if old_segments:
+                with output_file_path.open('rb') as source_file:
+                    for segment in old_segments:
+                        offset = output_file.tell()
+                        _copy_byte_range(source_file, output_file, segment['offset'], segment['n_bytes'])
+                        segment['offset'] = offset
+                        kept_segments.append(segment)
+
+            append_segments(output_file)
+
+        os.replace(temp_file_path, output_file_path)
+        manifest['header_bytes'] = len(header_bytes)
+
+    manifest['segments'] = kept_segments
+    manifest_path.write_text(json.dumps(manifest, indent=1), encoding='utf-8')
+
+    return incremental_report(
+        n_unchanged = len(kept_segments) - len(pending_paths),
+        n_added     = len(pending_paths) - n_changed,
+        n_changed   = n_changed,
+        n_removed   = len(removed_segments)
+    )
+
+#------------------------------------------------------------------------------    
+# Sharded output. Rows go to several csv files in one directory, by the hash of
+# a key column (n_shards files), by the value of a key column (one file per
+# value) or in order, rolling to a new file when one reaches max_bytes. Every
+# shard has its own buffered file and header, and shard_index.json lists the
+# shards with their row and byte counts. An existing directory is appended to.
+#------------------------------------------------------------------------------    
+class sharded_csv_writer:
+    index_file_name = 'shard_index.json'
+
+    def __init__(self, output_directory, preferred_headers, idx_key=None, n_shards=None, max_bytes=None,
+                 file_prefix='part', buffer_size=2**20, max_open_files=64):
+        if (idx_key is None) == (max_bytes is None):
+            raise ValueError('Give either a key column or a maximum shard size')
+        if n_shards is not None and idx_key is None:
+            raise ValueError('Hash sharding needs a key column')
+
+        self.output_directory = output_directory
+        self.idx_key = idx_key
+        self.n_shards = n_shards
+        self.max_bytes = max_bytes
+        self.file_prefix = file_prefix
+        self.buffer_size = buffer_size
+        self.max_open_files = max_open_files
+
+        self.header_bytes = _csv_bytes([preferred_headers])
+        self._open_files = collections.OrderedDict()
+
+        settings = {'headers': list(preferred_headers), 'idx_key': idx_key, 'n_shards': n_shards, 'max_bytes': max_bytes}
+        index_path = output_directory.joinpath(self.index_file_name)
+
+        if index_path.exists():
+            self._index = json.loads(index_path.read_text(encoding='utf-8'))
+            if self._index['settings'] != settings:
+                raise ValueError('Output directory holds shards written with other settings: ' + str(output_directory))
+        else:
+            output_directory.mkdir(parents=True, exist_ok=True)
+            self._index = {'settings': settings, 'shards': []}
+
+        # Hash mode always has all its shards, even ones no key maps to
+        if n_shards is not None:
+            self._shard(n_shards - 1)
+
+        # Shard number of each key value, in value mode
+        self._key_shards = {x['key']: k for (k, x) in enumerate(self._index['shards']) if 'key' in x}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _shard(self, idx_shard, key=None):
+        # Create shards up to 'idx_shard'. Every shard in the index has a file,
+        # which starts with the header.
+        shards = self._index['shards']
+        while len(shards) <= idx_shard:
+            shard = {'file_name': self.file_prefix + '-' + str(len(shards)).zfill(5) + '.csv', 'n_rows': 0, 'n_bytes': len(self.header_bytes)}
+            if self.n_shards is None and self.idx_key is not None:
+                shard['key'] = key
+
+            self.output_directory.joinpath(shard['file_name']).write_bytes(self.header_bytes)
+            shards.append(shard)
+
+        return shards[idx_shard]
+
+    def _write_shard(self, idx_shard, rows, key=None):
+        shard = self._shard(idx_shard, key)
+
+        shard_file = self._open_files.pop(idx_shard, None)
+        if shard_file is None:
+            if len(self._open_files) >= self.max_open_files:
+                self._open_files.popitem(last=False)[1].close()
+            shard_file = self.output_directory.joinpath(shard['file_name']).open('ab', buffering=self.buffer_size)
+        self._open_files[idx_shard] = shard_file
+
+        row_bytes = _csv_bytes(rows)
+        shard_file.write(row_bytes)
+        shard['n_rows'] += len(rows)
+        shard['n_bytes'] += len(row_bytes)
+
+    def write(self, column_values, batch_size=1000):
+        # Write one block of column_values
+        n_rows = chunk_length(column_values)
+        rows = list(zip(*[_column_list(x, n_rows) for x in column_values]))
+
+        if self.max_bytes is not None:
+            # Size is checked between batches, so a shard can pass max_bytes by
+            # at most one batch.
+            idx_shard = max(len(self._index['shards']) - 1, 0)
+            for idx_row in range(0, len(rows), batch_size):
+                shard = self._shard(idx_shard)
+                if shard['n_rows'] and shard['n_bytes'] >= self.max_bytes:
+                    idx_shard += 1
+                self._write_shard(idx_shard, rows[idx_row:idx_row + batch_size])
+            return
+
+        key_rows = collections.defaultdict(list)
+        for row in rows:
+            key_rows[row[self.idx_key]].append(row)
+
+        if self.n_shards is not None:
+            shard_rows = collections.defaultdict(list)
+            for (key, i_rows) in key_rows.items():
+                idx_shard = zlib.crc32(('' if key is None else str(key)).encode('utf-8')) % self.n_shards
+                shard_rows[idx_shard].extend(i_rows)
+
+            for (idx_shard, i_rows) in sorted(shard_rows.items()):
+                self._write_shard(idx_shard, i_rows)
+        else:
+            for (key, i_rows) in key_rows.items():
+                # Keys are stored in the json index, so use their text
+                key = None if key is None else str(key)
+                if key not in self._key_shards:
+                    self._key_shards[key] = len(self._index['shards'])
+                self._write_shard(self._key_shards[key], i_rows, key)
+
+    def shards(self):
+        return [dict(x, file_path=self.output_directory.joinpath(x['file_name'])) for x in self._index['shards']]
+
+    def close(self):
+        for shard_file in self._open_files.values():
+            shard_file.close()
+        self._open_files.clear()
+
+        self.output_directory.joinpath(self.index_file_name).write_text(json.dumps(self._index, indent=1), encoding='utf-8')
+
+#------------------------------------------------------------------------------    
+def process_data_sharded(input_file_paths, output_directory, data_processor, canonical_headers, preferred_headers,
+                         idx_key=None, n_shards=None, max_bytes=None, chunk_size=100000):
+    # process_data for several input files, writing to shards. 'idx_key' is
+    # the index of the key column in the processed column_values.
+    with sharded_csv_writer(output_directory, preferred_headers, idx_key, n_shards, max_bytes) as shard_writer:
+        for input_file_path in input_file_paths:
+            with input_file_path.open('r', newline='', encoding='utf-8') as csv_file:
+                csv_reader = csv.reader(csv_file)    
+                (headers, column_chunks) = process_csv_data(csv_reader, chunk_size=chunk_size)
+
+                mapping = compile_column_mapping(canonical_headers, headers)
+                column_chunks = map(mapping.apply, column_chunks)
+
+                try:
+                    for column_values in process_column_chunks(data_processor, column_chunks):
+                        shard_writer.write(column_values)
+                except ParsingError as parse_error:
+                    parse_error.file_name = input_file_path.name
+                    raise parse_error
+
+        return shard_writer.shards()
+
+#------------------------------------------------------------------------------    
+# External merge sort of a csv file on some of its columns. Blocks of rows that
+# fit in the memory budget are sorted (in worker processes if 'max_workers' is
+# given) and spilled to run files, which are then merged. Keys compare as text.
+# The sort is stable, so with 'dedupe' the first row of each key in the file
+# is the one kept.
+#------------------------------------------------------------------------------    
+class sort_report(typing.NamedTuple):
+    n_rows_in  : int
+    n_rows_out : int
+    n_runs     : int
+
+#------------------------------------------------------------------------------    
+def _dedupe_sorted_rows(rows, row_key):
+    previous_key = object()
+    for row in rows:
+        key = row_key(row)
+        if key != previous_key:
+            previous_key = key
+            yield row
+
+#------------------------------------------------------------------------------    
+def _sort_run(rows, idx_keys, dedupe, run_file_path=None):
+    # Sort one block of rows, and write it to 'run_file_path' if given
+    row_key = operator.itemgetter(*idx_keys)
+    rows.sort(key=row_key)
+
+    if dedupe:
+        rows = list(_dedupe_sorted_rows(rows, row_key))
+
+    if run_file_path is None:
+        return rows
+
+    with run_file_path.open('w', newline='', encoding='utf-8') as run_file:
+        csv.writer(run_file).writerows(rows)
+
+    return len(rows)
+
+#------------------------------------------------------------------------------    
+def _generate_row_blocks(csv_reader, memory_budget, n_sample=1000):
+    # Blocks of rows of about 'memory_budget' bytes, with the row size
+    # estimated from the first rows.
+    first_rows = list(itertools.islice(csv_reader, n_sample))
+    if not first_rows:
+        return
+
+    row_bytes = sum(sum(map(len, x)) + 56 * len(x) + 64 for x in first_rows) / len(first_rows)
+    block_size = max(int(memory_budget / row_bytes), n_sample)
+
+    csv_rows = itertools.chain(first_rows, csv_reader)
+    while True:
+        rows = list(itertools.islice(csv_rows, block_size))
+        if not rows:
+            return
+        yield rows
+
+#------------------------------------------------------------------------------    
+def sort_csv_file(input_file_path, output_file_path, key_headers, dedupe=False, memory_budget=2**28,
+                  spill_directory=None, max_workers=None):
+    # 'output_file_path' may be 'input_file_path'; the sorted file replaces it.
+    # With 'max_workers', several blocks are in memory at once, so each gets
+    # an equal share of 'memory_budget'.
+    n_blocks_in_memory = max_workers + 1 if max_workers else 1
+    temp_file_path = output_file_path.with_name(output_file_path.name + '.tmp')
+
+    with input_file_path.open('r', newline='', encoding='utf-8') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        headers = next(csv_reader)
+
+        missing_headers = [x for x in key_headers if x not in headers]
+        if missing_headers:
+            raise ValueError('Sort columns not in file: ' + ', '.join(missing_headers))
+
+        idx_keys = [headers.index(x) for x in key_headers]
+        row_key = operator.itemgetter(*idx_keys)
+
+        row_blocks = _generate_row_blocks(csv_reader, memory_budget // n_blocks_in_memory)
+        first_blocks = list(itertools.islice(row_blocks, 2))
+
+        if len(first_blocks) < 2:
+            # Everything fits in memory, so no runs are needed
+            rows = first_blocks[0] if first_blocks else []
+            n_rows_in = len(rows)
+            rows = _sort_run(rows, idx_keys, dedupe)
+
+            with temp_file_path.open('w', newline='', encoding='utf-8') as output_file:
+                writer = csv.writer(output_file)
+                writer.writerow(headers)
+                writer.writerows(rows)
+
+            report = sort_report(n_rows_in, len(rows), 0)
+        else:
+            run_directory = pathlib.Path(tempfile.mkdtemp(prefix='sort_runs_', dir=spill_directory))
+            run_file_paths = []
+            n_rows_in = 0
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) if max_workers else None
+
+            try:
+                in_flight = collections.deque()
+
+                for rows in itertools.chain(first_blocks, row_blocks):
+                    n_rows_in += len(rows)
+                    run_file_paths.append(run_directory.joinpath('run-' + str(len(run_file_paths)).zfill(5) + '.csv'))
+
+                    if executor is None:
+                        _sort_run(rows, idx_keys, dedupe, run_file_paths[-1])
+                        continue
+
+                    if len(in_flight) >= max_workers:
+                        in_flight.popleft().result()
+                    in_flight.append(executor.submit(_sort_run, rows, idx_keys, dedupe, run_file_paths[-1]))
+
+                del first_blocks, rows
+
+                for future in in_flight:
+                    future.result()
+
+                # Merge runs in file order, so ties keep their order in the file
+                run_files = [x.open('r', newline='', encoding='utf-8', buffering=2**20) for x in run_file_paths]
+                n_rows_out = 0
+
+                try:
+                    merged_rows = heapq.merge(*[csv.reader(x) for x in run_files], key=row_key)
+                    if dedupe:
+                        merged_rows = _dedupe_sorted_rows(merged_rows, row_key)
+
+                    with temp_file_path.open('w', newline='', encoding='utf-8') as output_file:
+                        writer = csv.writer(output_file)
+                        writer.writerow(headers)
+                        for row in merged_rows:
+                            writer.writerow(row)
+                            n_rows_out += 1
+                finally:
+                    for run_file in run_files:
+                        run_file.close()
+            finally:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+                shutil.rmtree(run_directory, ignore_errors=True)
+
+            report = sort_report(n_rows_in, n_rows_out, len(run_file_paths))
+
+    os.replace(temp_file_path, output_file_path)
+
+    return report
+
+#------------------------------------------------------------------------------    
+# Joins and group-by aggregation on column_values, so that simple joins and
+# grouped counts of cleaned tables don't need a dataframe. Columns may be
+# lists, masked arrays or excluded (infinite) columns; None and masked values
+# are nulls. As in SQL, null keys never match and aggregations skip nulls.
+#------------------------------------------------------------------------------    
+def _column_list(column, n_rows):
+    if isinstance(column, numpy.ma.MaskedArray):
+        return column.tolist()
+    if isinstance(column, numpy.ndarray):
+        return column.tolist()
+    if not hasattr(column, '__len__'):
+        return list(itertools.islice(column, n_rows))
+    return column
+
+#------------------------------------------------------------------------------    
+def _column_keys(column_values, idx_keys, n_rows):
+    key_columns = [_column_list(column_values[idx], n_rows) for idx in idx_keys]
+
+    if len(key_columns) == 1:
+        return key_columns[0]
+
+    # Composite keys with any null part are null
+    return [None if None in key else key for key in zip(*key_columns)]
+
+#------------------------------------------------------------------------------    
+def hash_join_columns(left_column_values, right_column_chunks, idx_left_keys, idx_right_keys, how='inner', n_right_columns=None):
+    # The left table is held in memory as the build side; the right table is
+    # streamed block by block as the probe side. Each block yields
+    # column_values of the left columns followed by the right columns. With
+    # how='left', left rows that matched nothing come last, with null right
+    # columns; 'n_right_columns' gives their number if the right table may
+    # have no blocks at all.
+    if how not in ('inner', 'left'):
+        raise ValueError('Unsupported join type: ' + str(how))
+    if len(idx_left_keys) != len(idx_right_keys):
+        raise ValueError('Join keys differ in length')
+
+    n_left_rows = chunk_length(left_column_values)
+    left_columns = [_column_list(x, n_left_rows) for x in left_column_values]
+
+    build_index = collections.defaultdict(list)
+    for (idx_row, key) in enumerate(_column_keys(left_columns, idx_left_keys, n_left_rows)):
+        if key is not None:
+            build_index[key].append(idx_row)
+
+    matched_rows = numpy.zeros(n_left_rows, dtype=bool)
+
+    for right_column_values in right_column_chunks:
+        n_rows = chunk_length(right_column_values)
+        right_columns = [_column_list(x, n_rows) for x in right_column_values]
+        n_right_columns = len(right_columns)
+
+        idx_left_rows = []
+        idx_right_rows = []
+        for (idx_row, key) in enumerate(_column_keys(right_columns, idx_right_keys, n_rows)):
+            for idx_left_row in build_index.get(key, ()):
+                idx_left_rows.append(idx_left_row)
+                idx_right_rows.append(idx_row)
+
+        matched_rows[idx_left_rows] = True
+
+        yield ([[column[idx] for idx in idx_left_rows] for column in left_columns] + 
+               [[column[idx] for idx in idx_right_rows] for column in right_columns])
+
+    if how == 'left' and not matched_rows.all():
+        idx_left_rows = numpy.flatnonzero(~matched_rows).tolist()
+
+        yield ([[column[idx] for idx in idx_left_rows] for column in left_columns] + 
+               [[None] * len(idx_left_rows) for k in range(n_right_columns or 0)])
+
+#------------------------------------------------------------------------------    
+aggregation_names = ('count', 'sum', 'min', 'max', 'mean')
+
+#------------------------------------------------------------------------------    
+def group_by_columns(column_chunks, idx_keys, aggregations):
+    # Aggregate streamed blocks of column_values by the key columns. Each
+    # aggregation is a pair (name, idx_col) with name in aggregation_names;
+    # ('count', None) counts rows. Value columns must already be parsed to
+    # numbers (or other comparable values for min and max). Returns
+    # column_values of the key columns followed by one column per aggregation,
+    # with groups in the order they were first seen. Groups with only null
+    # values get a null result, except for count.
+    for (name, idx_col) in aggregations:
+        if name not in aggregation_names:
+            raise ValueError('Unsupported aggregation: ' + str(name))
+        if idx_col is None and name != 'count':
+            raise ValueError('Aggregation needs a column: ' + name)
+
+    groups = {}
+    # One state dictionary per aggregation: count for count, sum for sum,
+    # extreme value for min and max, [sum, count] for mean.
+    states = [{} for k in aggregations]
+
+    for column_values in column_chunks:
+        n_rows = chunk_length(column_values)
+
+        keys = (list(zip(*[_column_list(column_values[idx], n_rows) for idx in idx_keys])) if len(idx_keys) != 1
+                else [(x,) for x in _column_list(column_values[idx_keys[0]], n_rows)])
+
+        for key in keys:
+            if key not in groups:
+                groups[key] = len(groups)
+
+        for ((name, idx_col), state) in zip(aggregations, states):
+            if idx_col is None:
+                for key in keys:
+                    state[key] = state.get(key, 0) + 1
+                continue
+
+            values = _column_list(column_values[idx_col], n_rows)
+
+            if name == 'count':
+                for (key, value) in zip(keys, values):
+                    if value is not None:
+                        state[key] = state.get(key, 0) + 1
+            elif name == 'sum':
+                for (key, value) in zip(keys, values):
+                    if value is not None:
+                        state[key] = state[key] + value if key in state else value
+            elif name == 'min':
+                for (key, value) in zip(keys, values):
+                    if value is not None and (key not in state or value < state[key]):
+                        state[key] = value
+            elif name == 'max':
+                for (key, value) in zip(keys, values):
+                    if value is not None and (key not in state or value > state[key]):
+                        state[key] = value
+            else:
+                for (key, value) in zip(keys, values):
+                    if value is not None:
+                        if key in state:
+                            state[key][0] += value
+                            state[key][1] += 1
+                        else:
+                            state[key] = [value, 1]
+
+    group_keys = list(groups)
+    key_columns = [list(x) for x in zip(*group_keys)] if group_keys else [[] for idx in idx_keys]
+
+    aggregate_columns = []
+    for ((name, idx_col), state) in zip(aggregations, states):
+        if name == 'count':
+            aggregate_columns.append([state.get(key, 0) for key in group_keys])
+        elif name == 'mean':
+            aggregate_columns.append([state[key][0] / state[key][1] if key in state else None for key in group_keys])
+        else:
+            aggregate_columns.append([state.get(key) for key in group_keys])
+
+    return key_columns + aggregate_columns
+
+#------------------------------------------------------------------------------    
+# One-pass column profiling with bounded memory. Each block of column_values
+# is counted once per column, and only the distinct values in the block update
+# the null count, min/max, a HyperLogLog sketch of the distinct count and a
+# Misra-Gries summary of the most frequent values. None and empty strings are
+# nulls.
+#------------------------------------------------------------------------------    
+class hyperloglog:
+    # Values are hashed with hash(), so sketches can only be merged within one
+    # process (string hashes are salted per process).
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError('HyperLogLog precision must be between 4 and 16')
+
+        self.precision = precision
+        self.registers = numpy.zeros(1 << precision, dtype=numpy.uint8)
+
+    def update(self, values):
+        h = numpy.fromiter(map(hash, values), dtype=numpy.int64, count=len(values)).view(numpy.uint64)
+
+        # splitmix64 finalizer, since hash() of an int is the int itself
+        h = (h ^ (h >> numpy.uint64(30))) * numpy.uint64(0xbf58476d1ce4e5b9)
+        h = (h ^ (h >> numpy.uint64(27))) * numpy.uint64(0x94d049bb133111eb)
+        h = h ^ (h >> numpy.uint64(31))
+
+        idx = (h & numpy.uint64(len(self.registers) - 1)).astype(numpy.intp)
+        w = h >> numpy.uint64(self.precision)
+
+        # Exact bit lengths; floats only hold 53 bits, so shift large words first
+        large = w >= numpy.uint64(1 << 52)
+        bit_length = numpy.where(large,
+                                 numpy.frexp((w >> numpy.uint64(12)).astype(numpy.float64))[1] + 12,
+                                 numpy.frexp(w.astype(numpy.float64))[1])
+        rank = (65 - self.precision - bit_length).astype(numpy.uint8)
+
+        numpy.maximum.at(self.registers, idx, rank)
+
+    def merge(self, other):
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw_estimate = alpha * m * m / numpy.sum(numpy.ldexp(1.0, -self.registers.astype(numpy.int64)))
+
+        # Linear counting is more accurate for small cardinalities
+        n_zeros = int(numpy.count_nonzero(self.registers == 0))
+        if raw_estimate <= 2.5 * m and n_zeros:
+            return round(m * math.log(m / n_zeros))
+
+        return round(raw_estimate)
+
+#------------------------------------------------------------------------------    
+class column_profile(typing.NamedTuple):
+    n_values   : int
+    n_null     : int
+    min_value  : object
+    max_value  : object
+    n_distinct : int    # approximate
+    top_values : list   # [(value, count)], most frequent first; counts are lower bounds
+
+#------------------------------------------------------------------------------    
+class column_profiler:
+    def __init__(self, n_columns, top_k=5, precision=12, n_counters=None):
+        self.top_k = top_k
+        # More counters than top_k keep the top counts accurate for skewed data
+        self.n_counters = n_counters or max(10 * top_k, 100)
+
+        self.n_values = 0
+        self.n_null = [0] * n_columns
+        self.min_values = [None] * n_columns
+        self.max_values = [None] * n_columns
+        self.sketches = [hyperloglog(precision) for k in range(n_columns)]
+        self.counters = [{} for k in range(n_columns)]
+
+    def update(self, column_values):
+        n_rows = chunk_length(column_values)
+        self.n_values += n_rows
+
+        for (idx, column) in enumerate(column_values):
+            value_counts = collections.Counter(_column_list(column, n_rows))
+            self.n_null[idx] += value_counts.pop(None, 0) + value_counts.pop('', 0)
+
+            if not value_counts:
+                continue
+
+            distinct_values = list(value_counts)
+            try:
+                (low, high) = (min(distinct_values), max(distinct_values))
+                if self.min_values[idx] is None or low < self.min_values[idx]:
+                    self.min_values[idx] = low
+                if self.max_values[idx] is None or high > self.max_values[idx]:
+                    self.max_values[idx] = high
+            except TypeError:
+                # Values that cannot be ordered have no min or max
+                pass
+
+            self.sketches[idx].update(distinct_values)
+
+            counter = self.counters[idx]
+            for (value, count) in value_counts.items():
+                counter[value] = counter.get(value, 0) + count
+
+            if len(counter) > self.n_counters:
+                # Misra-Gries: subtract the largest count that doesn't fit
+                threshold = sorted(counter.values(), reverse=True)[self.n_counters]
+                self.counters[idx] = {x: c - threshold for (x, c) in counter.items() if c > threshold}
+
+    def profiles(self):
+        return [column_profile(
+                    n_values   = self.n_values,
+                    n_null     = self.n_null[idx],
+                    min_value  = self.min_values[idx],
+                    max_value  = self.max_values[idx],
+                    n_distinct = self.sketches[idx].estimate(),
+                    top_values = sorted(self.counters[idx].items(), key=lambda x: x[1], reverse=True)[:self.top_k]
+                ) for idx in range(len(self.sketches))]
+
+#------------------------------------------------------------------------------    
+def profile_columns(column_headers, column_chunks, top_k=5, precision=12):
+    # Profile streamed blocks of column_values in one pass. Returns a dict of
+    # column_profile by header.
+    profiler = column_profiler(len(column_headers), top_k, precision)
+
+    for column_values in column_chunks:
+        profiler.update(column_values)
+
+    return dict(zip(column_headers, profiler.profiles()))
 
 #------------------------------------------------------------------------------ 
 #------------------------------------------------------------------------------    
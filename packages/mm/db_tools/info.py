@@ -4,8 +4,10 @@ import pyodbc
 import csv
 
 import mm.text_output.base
+import mm.data_utilities
 
 import metadata
+import pool
 
 #------------------------------------------------------------------------------
 # Classes
@@ -29,7 +31,17 @@ class database_report(typing.NamedTuple):
 #------------------------------------------------------------------------------
 # Summary Table Functions
 #------------------------------------------------------------------------------
-def build_table_summary(column_descriptor_dict, variable_description_dict={}, table_format=mm.text_output.base.text_format.markdown):    
+def table_cell_string(value, max_length):
+    # Data values can hold anything; shorten them to 'max_length' characters,
+    # fold line breaks into spaces and escape pipes so the table row holds.
+    cell_str = str(value)
+    if len(cell_str) > max_length:
+        cell_str = cell_str[:max_length - 3] + '...'
+
+    return ' '.join(cell_str.splitlines()).replace('|', '\\|')
+
+#------------------------------------------------------------------------------
+def build_table_summary(column_descriptor_dict, variable_description_dict={}, table_format=mm.text_output.base.text_format.markdown, column_profile_dict=None):    
 
     # Parameters for empty variable descriptions
     placeholder_length = 50
@@ -57,15 +69,38 @@ def build_table_summary(column_descriptor_dict, variable_description_dict={}, ta
 
     column_values = [column_name, column_type, column_nullable, column_description]
 
+    # Optional profile columns, from profile_db_table or mm.data_utilities.profile_columns
+    if column_profile_dict is not None:
+        column_headers += ['Nulls', 'Min', 'Max', 'Distinct', 'Top Values']
+        column_values += [[], [], [], [], []]
+
+        for i_column_name in column_descriptor_dict.keys():
+            i_profile = column_profile_dict.get(i_column_name)
+
+            if i_profile is None:
+                profile_values = ['', '', '', '', '']
+            else:
+                profile_values = [
+                    i_profile.n_null, 
+                    '' if i_profile.min_value is None else table_cell_string(i_profile.min_value, placeholder_length),
+                    '' if i_profile.max_value is None else table_cell_string(i_profile.max_value, placeholder_length),
+                    i_profile.n_distinct,
+                    table_cell_string(', '.join(str(value) + ' (' + str(count) + ')' for (value, count) in i_profile.top_values), placeholder_length)
+                ]
+
+            for (column, value) in zip(column_values[4:], profile_values):
+                column.append(value)
+
     return mm.text_output.base.table_string(column_headers, column_values, table_format)
 
 #------------------------------------------------------------------------------
-def build_schema_table_summary(table_descriptor_dict={}, variable_description_dict={}, table_format=mm.text_output.base.text_format.markdown):    
+def build_schema_table_summary(table_descriptor_dict={}, variable_description_dict={}, table_format=mm.text_output.base.text_format.markdown, table_profile_dict=None):    
     
     schema_summary_dict = {}
 
     for i_table_name, i_table_descriptor in table_descriptor_dict.items():
-        schema_summary_dict[i_table_name] = table_summation(i_table_descriptor.table_type, build_table_summary(i_table_descriptor.column_descriptor_dict, variable_description_dict, table_format))
+        i_column_profile_dict = table_profile_dict.get(i_table_name) if table_profile_dict is not None else None
+        schema_summary_dict[i_table_name] = table_summation(i_table_descriptor.table_type, build_table_summary(i_table_descriptor.column_descriptor_dict, variable_description_dict, table_format, i_column_profile_dict))
 
     return schema_summary_dict
  
@@ -79,6 +114,28 @@ def build_database_schema_table_summary(schema_descriptor_dict={}, variable_desc
 
     return database_summary_dict
 
+#------------------------------------------------------------------------------
+# Profile Functions
+#------------------------------------------------------------------------------
+def profile_db_table(db_connection, db_name, db_schema, db_table, top_k=5, chunk_size=100000):
+    """Profiles table columns in one pass over the rows. Returns dict of column profiles."""
+    db_path =  db_name + '.' + db_schema + '.' + db_table
+    sql_command = 'select * from ' + db_path
+
+    with db_connection() as cnxn:
+        db_cursor = cnxn.cursor()
+        db_cursor.execute(sql_command)
+
+        column_names = [z[0] for z in db_cursor.description]
+        profiler = mm.data_utilities.column_profiler(len(column_names), top_k)
+
+        rows = db_cursor.fetchmany(chunk_size)
+        while rows:
+            profiler.update(list(zip(*rows)))
+            rows = db_cursor.fetchmany(chunk_size)
+
+    return dict(zip(column_names, profiler.profiles()))
+
 #------------------------------------------------------------------------------
 # Interpolation field Functions
 #------------------------------------------------------------------------------
@@ -199,7 +256,7 @@ def write_variable_description_template_file(output_file_path, variable_names, v
 if __name__ == '__main__':
 
     db_name = 'srm_badges'
-    db_connection = lambda : pyodbc.connect("DSN=ResearchData; Trusted_Connection=yes;")    
+    db_connection = pool.connection_pool(lambda : pyodbc.connect("DSN=ResearchData; Trusted_Connection=yes;"))
 
     db_schema = 'analysis'
     db_table = 'cross_section'
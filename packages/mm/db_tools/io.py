@@ -1,4 +1,12 @@
 import csv
+import io
+import gzip
+import lzma
+import bz2
+import itertools
+import time
+import typing
+import pyodbc
 import mm.data_utilities
 
 #------------------------------------------------------------------------------    
@@ -36,8 +44,181 @@ def insert_tuples_into_db(tuple_data, column_names, db_cursor, db_table_name, db
     db_cursor.commit()
 
 #------------------------------------------------------------------------------    
-def insert_csv_into_db(data_file_path, db_table_name, db_schema_name, db_name, db_connection, column_names, data_processor):
-    """Insert the 'data_file_path' (a csv file) database table."""
+# Bulk insert engine. Rows are sent in batches of 'batch_size' with
+# fast_executemany where the cursor supports it, and committed every
+# 'commit_interval' batches. Batches since the last commit are kept, so when a
+# batch fails with one of 'retryable_errors' (e.g. a timeout) the transaction
+# is rolled back and only those batches are sent again, up to 'max_retries'
+# times. Retries reuse the cursor's connection, so a dropped connection is not
+# recovered: if the rollback fails, the last error is raised. Other errors
+# roll back and are raised.
+#------------------------------------------------------------------------------    
+class insert_report(typing.NamedTuple):
+    n_rows          : int
+    n_batches       : int
+    n_retries       : int
+    elapsed_seconds : float
+    rows_per_second : float
+
+#------------------------------------------------------------------------------    
+# Character types whose sizes are passed to setinputsizes. Sizes of other
+# types are left to the driver.
+character_type_dict = {
+    'char'    : pyodbc.SQL_CHAR,
+    'varchar' : pyodbc.SQL_VARCHAR,
+    'nchar'   : pyodbc.SQL_WCHAR,
+    'nvarchar': pyodbc.SQL_WVARCHAR,
+}
+
+#------------------------------------------------------------------------------    
+def build_input_sizes(column_names, column_descriptor_dict):
+    """Parameter sizes for setinputsizes from metadata.fetch_table column descriptors."""
+    input_sizes = []
+
+    for column_name in column_names:
+        descriptor = column_descriptor_dict.get(column_name)
+        sql_type = character_type_dict.get(descriptor.database_type.strip().lower()) if descriptor else None
+
+        if sql_type is None:
+            input_sizes.append(None)
+        else:
+            # (max) columns report a huge or non-positive size; 0 streams them
+            size = descriptor.size if descriptor.size and 0 < descriptor.size <= 8000 else 0
+            input_sizes.append((sql_type, size, 0))
+
+    return input_sizes
+
+#------------------------------------------------------------------------------    
+def print_insert_progress(n_rows, elapsed_seconds):
+    print(str(n_rows) + ' rows, ' + str(round(n_rows / max(elapsed_seconds, 1e-9))) + ' rows/sec')
+
+#------------------------------------------------------------------------------    
+def bulk_insert_into_db(rows, column_names, db_cursor, db_table_name, db_schema_name, db_name,
+                        batch_size=10000, commit_interval=10, fast_executemany=True, column_descriptor_dict=None,
+                        max_retries=3, retry_delay=1.0, retryable_errors=(pyodbc.OperationalError,), progress_callback=None):
+    """Insert the row tuples in 'rows' (any iterable) into database table in committed batches."""
+    db_path =  db_name + '.' + db_schema_name + '.' + db_table_name
+    n_columns = len(column_names)
+
+    sql_commands = 'insert into ' + db_path
+    sql_variables = '(' + ','.join(column_names) + ')'
+    sql_parameters = 'Values(' + '?,'*(n_columns-1) + '?)'
+
+    sql_full_command = sql_commands + sql_variables + sql_parameters
+
+    if fast_executemany and hasattr(db_cursor, 'fast_executemany'):
+        db_cursor.fast_executemany = True
+
+    input_sizes = build_input_sizes(column_names, column_descriptor_dict) if column_descriptor_dict else None
+    if input_sizes and any(input_sizes) and hasattr(db_cursor, 'setinputsizes'):
+        db_cursor.setinputsizes(input_sizes)
+
+    cnxn = db_cursor.connection
+    rows = iter(rows)
+    uncommitted_batches = []
+    n_rows = 0
+    n_batches = 0
+    n_retries = 0
+    start_time = time.perf_counter()
+
+    def rollback():
+        # Returns False if the connection is unusable
+        try:
+            cnxn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def commit():
+        nonlocal n_rows
+        cnxn.commit()
+        n_rows += sum(len(x) for x in uncommitted_batches)
+        uncommitted_batches.clear()
+
+        if progress_callback:
+            progress_callback(n_rows, time.perf_counter() - start_time)
+
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+
+        uncommitted_batches.append(batch)
+        n_batches += 1
+
+        try:
+            db_cursor.executemany(sql_full_command, batch)
+        except retryable_errors as batch_error:
+            # Roll back and resend everything since the last commit
+            last_error = batch_error
+
+            for i_retry in range(max_retries):
+                if not rollback():
+                    break
+                n_retries += 1
+                time.sleep(retry_delay * 2 ** i_retry)
+
+                try:
+                    for i_batch in uncommitted_batches:
+                        db_cursor.executemany(sql_full_command, i_batch)
+                    last_error = None
+                    break
+                except retryable_errors as retry_error:
+                    last_error = retry_error
+                except Exception:
+                    rollback()
+                    raise
+
+            if last_error is not None:
+                rollback()
+                raise last_error
+        except Exception:
+            # Errors in the data or SQL would fail again
+            rollback()
+            raise
+
+        if len(uncommitted_batches) >= commit_interval:
+            commit()
+
+    if uncommitted_batches:
+        commit()
+
+    elapsed_seconds = time.perf_counter() - start_time
+
+    return insert_report(
+        n_rows          = n_rows,
+        n_batches       = n_batches,
+        n_retries       = n_retries,
+        elapsed_seconds = elapsed_seconds,
+        rows_per_second = n_rows / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    )
+
+#------------------------------------------------------------------------------    
+def insert_csv_into_db(data_file_path, db_table_name, db_schema_name, db_name, db_connection, column_names, data_processor, chunk_size=None, **bulk_insert_options):
+    """Insert the 'data_file_path' (a csv file) database table. If 'chunk_size' is given the file is streamed in blocks of that many rows
+    through bulk_insert_into_db, which takes 'bulk_insert_options'. A ParsingError in a block is raised; batches committed before
+    it stay in the table."""
+    if chunk_size:
+        with data_file_path.open('r', newline='', encoding='utf-8') as csv_file:
+            csv_reader = csv.reader(csv_file)    
+            (_column_headers, column_chunks) = mm.data_utilities.process_csv_data(csv_reader, chunk_size=chunk_size)
+
+            column_chunks = mm.data_utilities.process_column_chunks(data_processor, column_chunks)
+            rows = itertools.chain.from_iterable(zip(*column_values) for column_values in column_chunks)
+
+            # Database Connection and Cursor
+            with db_connection() as cnxn:
+                db_cursor = cnxn.cursor()
+
+                try:
+                    report = bulk_insert_into_db(rows, column_names, db_cursor, db_table_name, db_schema_name, db_name, **bulk_insert_options)
+                    print_insert_progress(report.n_rows, report.elapsed_seconds)
+                except mm.data_utilities.ParsingError as parse_error:
+                    parse_error.file_name = data_file_path.name
+                    raise
+
+        return
+
     with data_file_path.open('r', newline='', encoding='utf-8') as csv_file:
         csv_reader = csv.reader(csv_file)    
         (_column_headers, column_values) = mm.data_utilities.process_csv_data(csv_reader)
@@ -54,22 +235,60 @@ def insert_csv_into_db(data_file_path, db_table_name, db_schema_name, db_name, d
         insert_into_db(column_values, column_names, db_cursor, db_table_name, db_schema_name, db_name)
 
 #------------------------------------------------------------------------------ 
-def write_db_data_2_file(output_file_path, db_connection, db_name, db_schema, db_table):
+class export_report(typing.NamedTuple):
+    n_rows          : int
+    n_bytes         : int   # bytes in the output file, after any compression
+    elapsed_seconds : float
+    rows_per_second : float
+
+#------------------------------------------------------------------------------ 
+compressed_writer_dict = {
+    'gzip': lambda raw_file: gzip.GzipFile(fileobj=raw_file, mode='wb'),
+    'lzma': lambda raw_file: lzma.LZMAFile(raw_file, mode='wb'),
+    'bz2' : lambda raw_file: bz2.BZ2File(raw_file, mode='wb'),
+}
+
+#------------------------------------------------------------------------------ 
+def write_db_data_2_file(output_file_path, db_connection, db_name, db_schema, db_table, arraysize=10000, compression=None, buffer_size=2**20):
+    """Write a database table to a csv file, 'arraysize' rows at a time. 'compression' is None, 'gzip', 'lzma' or 'bz2'."""
+    if compression is not None and compression not in compressed_writer_dict:
+        raise ValueError('Unsupported compression: ' + str(compression))
 
     db_path =  db_name + '.' + db_schema + '.' + db_table
     sql_command = 'select * from ' + db_path
 
+    n_rows = 0
+    start_time = time.perf_counter()
+
     # Database Connection and Cursor
     with db_connection()  as cnxn:
         db_cursor = cnxn.cursor()
-        column_names = [z[3] for z in db_cursor.columns(table=db_table, catalog=db_name, schema=db_schema)]
-        rows = db_cursor.execute(sql_command).fetchall()
-    
-    # Write table to file, with header
-    with output_file_path.open('w', newline='', encoding='utf-8') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(column_names)
-        writer.writerows(rows)
+        db_cursor.arraysize = arraysize
+        db_cursor.execute(sql_command)
+        column_names = [z[0] for z in db_cursor.description]
+
+        # Write table to file, with header
+        with output_file_path.open('wb', buffering=buffer_size) as raw_file:
+            binary_file = compressed_writer_dict[compression](raw_file) if compression else raw_file
+
+            with io.TextIOWrapper(binary_file, encoding='utf-8', newline='') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(column_names)
+
+                rows = db_cursor.fetchmany(arraysize)
+                while rows:
+                    writer.writerows(rows)
+                    n_rows += len(rows)
+                    rows = db_cursor.fetchmany(arraysize)
+
+    elapsed_seconds = time.perf_counter() - start_time
+
+    return export_report(
+        n_rows          = n_rows,
+        n_bytes         = output_file_path.stat().st_size,
+        elapsed_seconds = elapsed_seconds,
+        rows_per_second = n_rows / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    )
 
 #------------------------------------------------------------------------------ 
 #------------------------------------------------------------------------------    
@@ -1,5 +1,12 @@
 import pyodbc
 import typing
+import json
+import time
+import hashlib
+import os
+import threading
+import contextlib
+import concurrent.futures
 
 class column_descriptor(typing.NamedTuple):
     database_type: str
@@ -100,6 +107,246 @@ def fetch_database_schema_table(db_connection, db_name, db_schema_list):
 
     return schema_descriptor_dict
 
+#------------------------------------------------------------------------------
+# Concurrent fetch. Tables are fetched in a bounded thread pool in which each
+# worker opens one connection and keeps it for all its tables. Results are
+# assembled in catalog order, not completion order, so reports built from them
+# are stable from run to run.
+#------------------------------------------------------------------------------
+class _worker_connections:
+    """Thread pool whose workers each hold one connection from db_connection."""
+    def __init__(self, db_connection, max_workers):
+        # Workers keep their connection until the job ends, so a connection
+        # pool must be able to hand every worker one at the same time.
+        pool_size = getattr(db_connection, 'max_size', None)
+        if pool_size is not None:
+            max_workers = max(min(max_workers, pool_size), 1)
+
+        self.db_connection = db_connection
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.worker_state = threading.local()
+        self.worker_stacks = []
+        self.stack_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(cancel_futures=exc_type is not None)
+        for stack in self.worker_stacks:
+            stack.close()
+
+    def _run(self, fetch, args):
+        if not hasattr(self.worker_state, 'cnxn'):
+            stack = contextlib.ExitStack()
+            with self.stack_lock:
+                self.worker_stacks.append(stack)
+            self.worker_state.cnxn = stack.enter_context(self.db_connection())
+
+        return fetch(self.worker_state.cnxn, *args)
+
+    def map(self, fetch, args_list):
+        """Runs fetch(cnxn, *args) for each args. Returns results in the order of args_list."""
+        futures = [self.executor.submit(self._run, fetch, args) for args in args_list]
+        return [x.result() for x in futures]
+
+#------------------------------------------------------------------------------
+def _fetch_table_types(cnxn, db_name, db_schema):
+    db_cursor = cnxn.cursor()
+    return {z[2]: z[3] for z in db_cursor.tables(catalog=db_name, schema=db_schema)}
+
+#------------------------------------------------------------------------------
+def _fetch_table_columns(cnxn, db_name, db_schema, db_table):
+    db_cursor = cnxn.cursor()
+    return {z[3]: column_descriptor(database_type=z[5], size=z[6], nullable_bool=z[10] > 0)
+            for z in db_cursor.columns(catalog=db_name, schema=db_schema, table=db_table)}
+
+#------------------------------------------------------------------------------
+def fetch_database_schema_table_concurrent(db_connection, db_name, db_schema_list, max_workers=8):
+    """Fetches metadata on schemas and their tables, max_workers tables at a time. Returns dict of schema+table descriptors."""
+    with _worker_connections(db_connection, max_workers) as workers:
+        table_type_dicts = workers.map(_fetch_table_types, [(db_name, x) for x in db_schema_list])
+
+        table_jobs = [(schema_name, table_name, table_type) 
+                      for (schema_name, table_type_dict) in zip(db_schema_list, table_type_dicts) 
+                      for (table_name, table_type) in table_type_dict.items()]
+
+        column_descriptor_dicts = workers.map(_fetch_table_columns, [(db_name, x[0], x[1]) for x in table_jobs])
+
+    schema_descriptor_dict = {schema_name: dict() for schema_name in db_schema_list}
+
+    for ((schema_name, table_name, table_type), column_descriptor_dict) in zip(table_jobs, column_descriptor_dicts):
+        schema_descriptor_dict[schema_name][table_name] = table_descriptor(
+            table_type             = table_type,
+            column_descriptor_dict = column_descriptor_dict
+        )
+
+    return schema_descriptor_dict
+
+#------------------------------------------------------------------------------
+def fetch_schema_table_concurrent(db_connection, db_name, db_schema, max_workers=8):
+    """Fetches metadata on schema and its tables, max_workers tables at a time. Returns dict of table and schema descriptors."""
+    return fetch_database_schema_table_concurrent(db_connection, db_name, [db_schema], max_workers)[db_schema]
+
+#------------------------------------------------------------------------------
+# Bulk catalog fetch. One tables() and one columns() call cover every schema,
+# instead of a columns() round trip per table, and the rows are grouped here
+# into the same descriptors. Row layouts are as listed above.
+#------------------------------------------------------------------------------
+def _group_catalog_rows(table_rows, column_rows, db_schema_list):
+    schema_descriptor_dict = {schema_name: dict() for schema_name in db_schema_list}
+
+    for descriptor in table_rows:
+        table_descriptor_dict = schema_descriptor_dict.get(descriptor[1])
+
+        if table_descriptor_dict is not None:
+            table_descriptor_dict[descriptor[2]] = table_descriptor(
+                table_type             = descriptor[3],
+                column_descriptor_dict = dict()
+            )
+
+    for descriptor in column_rows:
+        table_descriptor_dict = schema_descriptor_dict.get(descriptor[1])
+        i_table_descriptor = table_descriptor_dict.get(descriptor[2]) if table_descriptor_dict is not None else None
+
+        if i_table_descriptor is not None:
+            i_table_descriptor.column_descriptor_dict[descriptor[3]] = column_descriptor(
+                database_type = descriptor[5], 
+                size          = descriptor[6],
+                nullable_bool = descriptor[10] > 0
+            )
+
+    return schema_descriptor_dict
+
+#------------------------------------------------------------------------------
+def fetch_database_schema_table_bulk(db_connection, db_name, db_schema_list):
+    """Fetches metadata on schemas and their tables in two catalog calls. Returns dict of schema+table descriptors."""
+    # A single schema can be filtered by the database, several are filtered here.
+    schema_filter = db_schema_list[0] if len(db_schema_list) == 1 else None
+
+    with db_connection() as cnxn:
+        db_cursor = cnxn.cursor()
+        table_rows = db_cursor.tables(catalog=db_name, schema=schema_filter).fetchall()
+        column_rows = db_cursor.columns(catalog=db_name, schema=schema_filter).fetchall()
+
+    return _group_catalog_rows(table_rows, column_rows, db_schema_list)
+
+#------------------------------------------------------------------------------
+def fetch_schema_table_bulk(db_connection, db_name, db_schema):
+    """Fetches metadata on schema and its tables in two catalog calls. Returns dict of table and schema descriptors."""
+    return fetch_database_schema_table_bulk(db_connection, db_name, [db_schema])[db_schema]
+
+#------------------------------------------------------------------------------
+# Persistent metadata cache. Table descriptors are kept in one json file per
+# (DSN, database, schema). Within 'ttl' seconds of the last check a schema is
+# served from disk without touching the database. After that a freshness probe
+# returns a modification stamp per table, and only tables whose stamp changed
+# are fetched again. Without a probe an expired schema is fetched in full.
+#------------------------------------------------------------------------------
+def sql_server_modify_dates(db_connection, db_name, db_schema):
+    """Freshness probe for SQL Server. Returns dict of table modify_date stamps."""
+    sql_command = ('select o.name, o.modify_date from ' + db_name + '.sys.objects o'
+                   ' join ' + db_name + '.sys.schemas s on o.schema_id = s.schema_id'
+                   " where s.name = ? and o.type in ('U', 'V')")
+
+    with db_connection() as cnxn:
+        db_cursor = cnxn.cursor()
+        rows = db_cursor.execute(sql_command, db_schema).fetchall()
+
+    return {z[0]: str(z[1]) for z in rows}
+
+#------------------------------------------------------------------------------
+def _encode_table_descriptor(i_table_descriptor):
+    return {'table_type': i_table_descriptor.table_type,
+            'columns'   : [[name] + list(x) for name, x in i_table_descriptor.column_descriptor_dict.items()]}
+
+#------------------------------------------------------------------------------
+def _decode_table_descriptor(table_entry):
+    return table_descriptor(
+        table_type             = table_entry['table_type'],
+        column_descriptor_dict = {x[0]: column_descriptor(*x[1:]) for x in table_entry['columns']}
+    )
+
+#------------------------------------------------------------------------------
+class metadata_cache:
+    def __init__(self, cache_directory, dsn, ttl=24*60*60, freshness_probe=sql_server_modify_dates):
+        self.cache_directory = cache_directory
+        self.dsn = dsn
+        self.ttl = ttl
+        self.freshness_probe = freshness_probe
+
+        cache_directory.mkdir(parents=True, exist_ok=True)
+
+    def cache_path(self, db_name, db_schema):
+        key_hash = hashlib.blake2b('\x00'.join([self.dsn, db_name, db_schema]).encode('utf-8'), digest_size=8).hexdigest()
+        return self.cache_directory.joinpath(db_name + '.' + db_schema + '.' + key_hash + '.json')
+
+    def _read(self, db_name, db_schema):
+        cache_path = self.cache_path(db_name, db_schema)
+        if not cache_path.exists():
+            return None
+        return json.loads(cache_path.read_text(encoding='utf-8'))
+
+    def _write(self, db_name, db_schema, cache_entry):
+        cache_path = self.cache_path(db_name, db_schema)
+        temp_path = cache_path.with_name(cache_path.name + '.tmp')
+        temp_path.write_text(json.dumps(cache_entry, indent=1), encoding='utf-8')
+        os.replace(temp_path, cache_path)
+
+    def invalidate(self, db_name, db_schema):
+        self.cache_path(db_name, db_schema).unlink(missing_ok=True)
+
+    def fetch_schema_table(self, db_connection, db_name, db_schema):
+        """Cached version of fetch_schema_table. Returns dict of table and schema descriptors."""
+        cache_entry = self._read(db_name, db_schema)
+        now = time.time()
+
+        if cache_entry is not None and now - cache_entry['checked_time'] < self.ttl:
+            return {name: _decode_table_descriptor(x) for name, x in cache_entry['tables'].items()}
+
+        if cache_entry is None or self.freshness_probe is None:
+            stamp_dict = self.freshness_probe(db_connection, db_name, db_schema) if self.freshness_probe else {}
+            table_descriptor_dict = fetch_schema_table_bulk(db_connection, db_name, db_schema)
+        else:
+            # Refresh only the tables whose stamps changed. Tables the probe
+            # stopped reporting were dropped; ones it never reported are kept.
+            stamp_dict = self.freshness_probe(db_connection, db_name, db_schema)
+            old_stamp_dict = cache_entry['stamps']
+            table_descriptor_dict = {name: _decode_table_descriptor(x) for name, x in cache_entry['tables'].items()
+                                     if name in stamp_dict or name not in old_stamp_dict}
+
+            changed_tables = [x for x in stamp_dict if old_stamp_dict.get(x) != stamp_dict[x] or x not in table_descriptor_dict]
+            new_tables = [x for x in changed_tables if x not in table_descriptor_dict]
+            table_type_dict = fetch_schema(db_connection, db_name, db_schema) if new_tables else {}
+
+            for table_name in changed_tables:
+                table_type = table_type_dict.get(table_name) if table_name in new_tables else table_descriptor_dict[table_name].table_type
+
+                table_descriptor_dict[table_name] = table_descriptor(
+                    table_type             = table_type,
+                    column_descriptor_dict = fetch_table(db_connection, db_name, db_schema, table_name)
+                )
+
+        self._write(db_name, db_schema, {
+            'dsn'         : self.dsn,
+            'db_name'     : db_name,
+            'db_schema'   : db_schema,
+            'checked_time': now,
+            'stamps'      : stamp_dict,
+            'tables'      : {name: _encode_table_descriptor(x) for name, x in table_descriptor_dict.items()}
+        })
+
+        return table_descriptor_dict
+
+    def fetch_database_schema_table(self, db_connection, db_name, db_schema_list):
+        """Cached version of fetch_database_schema_table. Returns dict of schema+table descriptors."""
+        schema_descriptor_dict = dict()
+
+        for schema_name in db_schema_list:
+            schema_descriptor_dict[schema_name] = self.fetch_schema_table(db_connection, db_name, schema_name)
+
+        return schema_descriptor_dict
+
 #------------------------------------------------------------------------------ 
 #------------------------------------------------------------------------------    
 # 
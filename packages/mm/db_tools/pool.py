@@ -0,0 +1,177 @@
+import contextlib
+import threading
+import time
+
+#------------------------------------------------------------------------------
+# Connection pool. A 'connection_pool' is called like the 'db_connection'
+# lambdas taken by the metadata, io and info functions,
+#
+#   db_connection = connection_pool(lambda : pyodbc.connect(connection_string))
+#
+#   with db_connection() as cnxn:
+#       ...
+#
+# but the block borrows an open connection instead of opening a new one. As
+# with pyodbc connections, the block commits on success and rolls back on an
+# exception; the connection then goes back to the pool. Any DB-API module
+# works, e.g. sqlite3 with check_same_thread=False so that connections can
+# move between threads.
+#------------------------------------------------------------------------------
+def ping_connection(cnxn):
+    """Default health check. Raises if the connection is unusable."""
+    cnxn.cursor().execute('select 1').fetchall()
+
+#------------------------------------------------------------------------------
+class connection_pool:
+    def __init__(self, connect, max_size=8, idle_timeout=300, health_check=ping_connection, health_check_interval=30, acquire_timeout=None):
+        """'connect' opens a new connection. Connections idle for more than
+        'idle_timeout' seconds are closed, and connections idle for more than
+        'health_check_interval' seconds are checked before they are reused."""
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._condition = threading.Condition()
+        self._idle = []     # (connection, time returned), most recent last
+        self._n_open = 0
+        self._closed = False
+
+    def __call__(self):
+        return self.connection()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def n_open(self):
+        return self._n_open
+
+    @property
+    def n_idle(self):
+        return len(self._idle)
+
+    def _close_quietly(self, cnxn):
+        try:
+            cnxn.close()
+        except Exception:
+            pass
+
+    def _discard(self, cnxn):
+        self._close_quietly(cnxn)
+        with self._condition:
+            self._n_open -= 1
+            self._condition.notify()
+
+    def _expire_idle(self, now):
+        # Called with the lock held. Returns connections past the idle timeout.
+        if self.idle_timeout is None:
+            return []
+
+        expired = [x for x in self._idle if now - x[1] > self.idle_timeout]
+        if expired:
+            self._idle = [x for x in self._idle if now - x[1] <= self.idle_timeout]
+            self._n_open -= len(expired)
+            self._condition.notify(len(expired))
+
+        return [x[0] for x in expired]
+
+    def acquire(self):
+        """Borrows a connection. Waits for one to be returned if 'max_size' are in use."""
+        deadline = None if self.acquire_timeout is None else time.monotonic() + self.acquire_timeout
+
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise RuntimeError('Connection pool is closed')
+
+                    now = time.monotonic()
+                    expired = self._expire_idle(now)
+
+                    if self._idle or self._n_open < self.max_size:
+                        break
+
+                    remaining = None if deadline is None else deadline - now
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError('No connection available within ' + str(self.acquire_timeout) + ' seconds')
+                    self._condition.wait(remaining)
+
+                if self._idle:
+                    (cnxn, returned_time) = self._idle.pop()
+                else:
+                    (cnxn, returned_time) = (None, None)
+                    self._n_open += 1
+
+            # Connections are opened, checked and closed outside the lock
+            for expired_cnxn in expired:
+                self._close_quietly(expired_cnxn)
+
+            if cnxn is None:
+                try:
+                    return self.connect()
+                except BaseException:
+                    with self._condition:
+                        self._n_open -= 1
+                        self._condition.notify()
+                    raise
+
+            if self.health_check is None or now - returned_time <= self.health_check_interval:
+                return cnxn
+
+            try:
+                self.health_check(cnxn)
+                return cnxn
+            except Exception:
+                self._discard(cnxn)
+
+    def release(self, cnxn, broken=False):
+        """Returns a borrowed connection, or closes it if it is 'broken' or the pool is closed."""
+        with self._condition:
+            if not (broken or self._closed):
+                self._idle.append((cnxn, time.monotonic()))
+                self._condition.notify()
+                return
+
+        self._discard(cnxn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager that borrows a connection, commits or rolls back, and returns it."""
+        cnxn = self.acquire()
+
+        try:
+            yield cnxn
+        except BaseException:
+            try:
+                cnxn.rollback()
+            except Exception:
+                self.release(cnxn, broken=True)
+            else:
+                self.release(cnxn)
+            raise
+
+        try:
+            cnxn.commit()
+        except BaseException:
+            self.release(cnxn, broken=True)
+            raise
+
+        self.release(cnxn)
+
+    def close(self):
+        """Closes idle connections. Borrowed connections are closed when returned."""
+        with self._condition:
+            self._closed = True
+            idle = [x[0] for x in self._idle]
+            self._idle = []
+            self._n_open -= len(idle)
+            self._condition.notify_all()
+
+        for cnxn in idle:
+            self._close_quietly(cnxn)
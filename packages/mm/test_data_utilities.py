@@ -0,0 +1,114 @@
+import csv
+import io
+import pathlib
+import tempfile
+
+import numpy
+
+import mm.data_utilities
+
+#------------------------------------------------------------------------------
+# mmap_csv_table must read files exactly as csv.reader does.
+#------------------------------------------------------------------------------
+mmap_csv_cases = [
+    'a,b\n1,2\n3,4\n',
+    'a,b\r\n1,2\r\n3,4',
+    'a,b\n5" x,6" y\n7,8\n',
+    'a,b\n"1,1","2 ""q"""\n3,4\n',
+    'a,b\n"multi\nline",2\n3,4\n',
+    'a,b\n"ab"cd,x\n',
+    'a,b\n1,"2\n',
+    'a,b\n1,"2\n3,4\n',
+    'a,b\n1,"2',
+    'a,b\n1\n\n3,4,5\n',
+    'a,b\n1,2\r',
+    'a,b,c\n1,2,3\n\r\n4\n"5",6\n7,8,9,10\n,\n',
+    'a,b\r\n1,2\r\n"3\r\n",4\r\n5,6',
+]
+
+#------------------------------------------------------------------------------
+def read_with_csv_reader(text):
+    # Blank lines are skipped and short rows padded with empty strings
+    rows = [x for x in csv.reader(io.StringIO(text, newline='')) if x]
+    headers = rows[0]
+    return [[x[k] if k < len(x) else '' for x in rows[1:]] for k in range(len(headers))]
+
+#------------------------------------------------------------------------------
+def test_mmap_csv_table_matches_csv_reader():
+    with tempfile.TemporaryDirectory() as temp_directory:
+        input_file_path = pathlib.Path(temp_directory).joinpath('input.csv')
+
+        # Small blocks make the bulk index stop mid file and around quotes
+        for block_size in (1, 5, 1 << 22):
+            table_class = type('mmap_csv_table', (mm.data_utilities.mmap_csv_table,), {'block_size': block_size})
+
+            for text in mmap_csv_cases:
+                input_file_path.write_bytes(text.encode('utf-8'))
+
+                with table_class(input_file_path) as table:
+                    assert table.column_values() == read_with_csv_reader(text), (block_size, text)
+
+                with table_class(input_file_path, keep_headers=['b']) as table:
+                    assert table.column_values()[1] == read_with_csv_reader(text)[1], (block_size, text)
+
+#------------------------------------------------------------------------------
+# Dirty cells parse to nulls in fixed point columns, they never raise.
+#------------------------------------------------------------------------------
+def test_parse_decimal_column_fixed_dirty_cells():
+    column = ['1.5', '\u00b2', '-2.345', '', None, ' 3 ', '1' * 30, '+.5', '.', '-', 'x' * 2000]
+    parsed = mm.data_utilities.parse_decimal_column_fixed(column, 2)
+
+    assert parsed.tolist() == [150, None, -234, None, None, 300, None, 50, None, None, None]
+    assert mm.data_utilities.parse_decimal_column_fixed([], 2).tolist() == []
+
+#------------------------------------------------------------------------------
+# Column containers iterate block by block to the same values as tolist.
+#------------------------------------------------------------------------------
+def test_column_iteration_in_blocks():
+    values = [None if k % 7 == 3 else k for k in range(100)]
+    masked_column = numpy.ma.MaskedArray([x or 0 for x in values], mask=[x is None for x in values])
+    text_values = [None if x is None else 'v' + str(x % 5) for x in values]
+
+    for block_size in (8, 16, 1 << 16):
+        typed_column = type('typed_column', (mm.data_utilities.typed_column,), {'block_size': block_size})
+        dictionary_column = type('dictionary_column', (mm.data_utilities.dictionary_column,), {'block_size': block_size})
+
+        assert list(typed_column.from_masked(masked_column)) == values
+        assert list(typed_column.from_masked(masked_column[:0])) == []
+        assert list(dictionary_column.from_list(text_values)) == text_values
+
+#------------------------------------------------------------------------------
+# A parse error in a later chunk leaves the output file as it was.
+#------------------------------------------------------------------------------
+def test_process_data_chunked_error_leaves_no_rows():
+    plan = mm.data_utilities.parse_plan(idx_boolean=[0])
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        input_file_path = pathlib.Path(temp_directory).joinpath('input.csv')
+        output_file_path = pathlib.Path(temp_directory).joinpath('output.csv')
+        input_file_path.write_text('a\nTrue\nFalse\nTrue\nx\n', encoding='utf-8')
+
+        for existing_bytes in (None, b'a\r\nFalse\r\n'):
+            if existing_bytes is not None:
+                output_file_path.write_bytes(existing_bytes)
+
+            try:
+                mm.data_utilities.process_data(input_file_path, output_file_path, plan, ['a'], ['a'], chunk_size=2)
+            except mm.data_utilities.ParsingError as parse_error:
+                assert parse_error.idx_row == 3
+            else:
+                assert False, 'ParsingError not raised'
+
+            if existing_bytes is None:
+                assert not output_file_path.exists()
+            else:
+                assert output_file_path.read_bytes() == existing_bytes
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    test_mmap_csv_table_matches_csv_reader()
+    test_parse_decimal_column_fixed_dirty_cells()
+    test_column_iteration_in_blocks()
+    test_process_data_chunked_error_leaves_no_rows()
+    print('test_data_utilities passed')
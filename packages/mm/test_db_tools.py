@@ -0,0 +1,182 @@
+import sqlite3
+import threading
+import time
+
+import pyodbc
+
+import mm.db_tools.io
+import mm.db_tools.pool
+
+#------------------------------------------------------------------------------
+# Connection pool, with in-memory sqlite databases as connections.
+#------------------------------------------------------------------------------
+class sqlite_connector:
+    # Opens sqlite connections and counts them
+    def __init__(self):
+        self.n_connect = 0
+
+    def __call__(self):
+        self.n_connect += 1
+        return sqlite3.connect(':memory:', check_same_thread=False)
+
+#------------------------------------------------------------------------------
+def test_pool_blocks_at_max_size():
+    connect = sqlite_connector()
+    db_connection = mm.db_tools.pool.connection_pool(connect, max_size=1, acquire_timeout=0.05)
+
+    cnxn = db_connection.acquire()
+    try:
+        db_connection.acquire()
+    except TimeoutError:
+        pass
+    else:
+        assert False, 'TimeoutError not raised'
+
+    # A waiting thread gets the connection once it is returned
+    db_connection.acquire_timeout = None
+    acquired = []
+    waiter = threading.Thread(target=lambda : acquired.append(db_connection.acquire()))
+    waiter.start()
+    waiter.join(0.05)
+    assert waiter.is_alive() and not acquired
+
+    db_connection.release(cnxn)
+    waiter.join(5)
+    assert acquired == [cnxn]
+    assert connect.n_connect == 1 and db_connection.n_open == 1
+
+    db_connection.release(cnxn)
+    db_connection.close()
+    assert db_connection.n_open == 0
+
+#------------------------------------------------------------------------------
+def test_pool_expires_idle_connections():
+    connect = sqlite_connector()
+    db_connection = mm.db_tools.pool.connection_pool(connect, idle_timeout=0)
+
+    with db_connection() as cnxn:
+        pass
+    assert db_connection.n_idle == 1
+
+    time.sleep(0.01)
+    with db_connection() as new_cnxn:
+        assert new_cnxn is not cnxn
+
+    assert connect.n_connect == 2 and db_connection.n_open == 1
+
+#------------------------------------------------------------------------------
+def test_pool_replaces_unhealthy_connections():
+    connect = sqlite_connector()
+    db_connection = mm.db_tools.pool.connection_pool(connect, max_size=1, health_check_interval=0)
+
+    with db_connection() as cnxn:
+        pass
+
+    # Closed behind the pool's back, so the health check fails
+    cnxn.close()
+    time.sleep(0.01)
+
+    with db_connection() as new_cnxn:
+        assert new_cnxn is not cnxn
+        assert new_cnxn.execute('select 1').fetchall() == [(1,)]
+
+    assert connect.n_connect == 2 and db_connection.n_open == 1
+
+#------------------------------------------------------------------------------
+# bulk_insert_into_db, through a cursor that can fail on chosen executemany
+# calls. A failing call first inserts a stray row, which the rollback must
+# remove.
+#------------------------------------------------------------------------------
+class failing_cursor:
+    def __init__(self, cnxn, failures):
+        self.connection = cnxn
+        self.failures = failures
+        self.n_calls = 0
+        self._cursor = cnxn.cursor()
+
+    def executemany(self, sql_command, rows):
+        self.n_calls += 1
+
+        # sqlite has no database part in table names
+        sql_command = sql_command.replace('db.main.t', 't')
+
+        error = self.failures.get(self.n_calls)
+        if error is not None:
+            self._cursor.execute('insert into t values (-1, \'stray\')')
+            if isinstance(error, type):
+                self.connection.close()
+                error = error('connection dropped')
+            raise error
+
+        return self._cursor.executemany(sql_command, rows)
+
+#------------------------------------------------------------------------------
+def run_bulk_insert(failures, rows, **bulk_insert_options):
+    cnxn = sqlite3.connect(':memory:')
+    cnxn.execute('create table t (a int primary key, b text)')
+    cnxn.commit()
+
+    db_cursor = failing_cursor(cnxn, failures)
+    try:
+        report = mm.db_tools.io.bulk_insert_into_db(rows, ['a', 'b'], db_cursor, 't', 'main', 'db', batch_size=2, commit_interval=2, retry_delay=0, **bulk_insert_options)
+        error = None
+    except Exception as insert_error:
+        (report, error) = (None, insert_error)
+
+    try:
+        table_rows = cnxn.execute('select a, b from t order by a').fetchall()
+    except sqlite3.ProgrammingError:
+        table_rows = None
+
+    return (report, error, db_cursor.n_calls, table_rows)
+
+#------------------------------------------------------------------------------
+def test_bulk_insert_retries_uncommitted_batches():
+    rows = [(k, 'x') for k in range(5)]
+    (report, error, n_calls, table_rows) = run_bulk_insert({2: pyodbc.OperationalError('timeout')}, rows)
+
+    # Batches 1 and 2 are resent after the failure, then batch 3 is sent
+    assert error is None
+    assert (report.n_rows, report.n_batches, report.n_retries) == (5, 3, 1)
+    assert n_calls == 5
+    assert table_rows == rows
+
+#------------------------------------------------------------------------------
+def test_bulk_insert_raises_last_error_after_max_retries():
+    failures = {k: pyodbc.OperationalError('timeout ' + str(k)) for k in (1, 2, 3)}
+    (report, error, n_calls, table_rows) = run_bulk_insert(failures, [(1, 'x')], max_retries=2)
+
+    assert str(error) == 'timeout 3'
+    assert n_calls == 3
+    assert table_rows == []
+
+#------------------------------------------------------------------------------
+def test_bulk_insert_does_not_retry_other_errors():
+    rows = [(k, 'x') for k in range(5)]
+    (report, error, n_calls, table_rows) = run_bulk_insert({3: ValueError('bad data')}, rows)
+
+    # Only the first commit, of batches 1 and 2, is kept
+    assert isinstance(error, ValueError)
+    assert n_calls == 3
+    assert table_rows == rows[:4]
+
+#------------------------------------------------------------------------------
+def test_bulk_insert_stops_on_dropped_connection():
+    (report, error, n_calls, table_rows) = run_bulk_insert({1: pyodbc.OperationalError}, [(1, 'x')])
+
+    # The rollback fails, so there is nothing to retry on
+    assert isinstance(error, pyodbc.OperationalError)
+    assert n_calls == 1
+    assert table_rows is None
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    test_pool_blocks_at_max_size()
+    test_pool_expires_idle_connections()
+    test_pool_replaces_unhealthy_connections()
+    test_bulk_insert_retries_uncommitted_batches()
+    test_bulk_insert_raises_last_error_after_max_retries()
+    test_bulk_insert_does_not_retry_other_errors()
+    test_bulk_insert_stops_on_dropped_connection()
+    print('test_db_tools passed')